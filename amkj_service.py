@@ -1,6 +1,7 @@
 from nintendo.nex import common, rmc
 from nex_protocols_common_py.authentication_protocol import AuthenticationUser
-from nex_protocols_common_py.ranking_protocol import RankingManager
+from mk8_ranking_protocol import MK8RankingManager, mii_name_cache
+from profiler import profiler
 
 from pymongo.collection import Collection
 
@@ -9,14 +10,43 @@ import amkj_service_pb2
 import amkj_service_pb2_grpc
 
 import asyncio
+import itertools
+
+import logging
+logger = logging.getLogger(__name__)
 
 from datetime import datetime, timezone
 from google.protobuf.timestamp_pb2 import Timestamp
 
+# Number of documents read from Mongo at a time by the streaming RPCs
+DEFAULT_STREAM_BATCH_SIZE = 100
+
+# Only the fields GetUnlocks needs, the common data blob itself can be large
+UNLOCKS_PROJECTION = {
+    "_id": 0,
+    "pid": 1,
+    "last_update": 1,
+    "vr_rate": 1,
+    "br_rate": 1,
+    "gp_unlocks": 1,
+    "engine_unlocks": 1,
+    "driver_unlocks": 1,
+    "body_unlocks": 1,
+    "tire_unlocks": 1,
+    "wing_unlocks": 1,
+    "stamp_unlocks": 1,
+    "dlc_unlocks": 1,
+}
+MAX_UNLOCKS_BATCH_SIZE = 5000
+
+# Largest page returned by GetTimeTrialRanking, bigger limits are lowered to it
+MAX_TIME_TRIAL_RANKING_PAGE_SIZE = 1000
+
 
 class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
 
-    def __init__(self, api_key: str, status_db: Collection, gatherings_db: Collection, tournaments_db: Collection, commondata_db: Collection, restrictions_db: Collection):
+    def __init__(self, api_key: str, status_db: Collection, gatherings_db: Collection, tournaments_db: Collection, commondata_db: Collection, restrictions_db: Collection,
+                 kick_concurrency: int = 64, kick_spread_time: float = 0.0):
         self.rmc_secure_server = None
         self.api_key = api_key
         self.status_db = status_db
@@ -24,7 +54,7 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
         self.tournaments_db = tournaments_db
         self.commondata_db = commondata_db
         self.restrictions_db = restrictions_db
-        self.ranking_mgr: RankingManager = None
+        self.ranking_mgr: MK8RankingManager = None
 
         self.is_online = False
         self.is_maintenance = False
@@ -39,10 +69,20 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
         self.rmc_clients: dict[int, rmc.RMCClient] = {}
         self.rmc_clients_lock = asyncio.Lock()
 
+        # While draining, clients are being kicked and no new session is accepted
+        self.kick_concurrency = kick_concurrency
+        self.kick_spread_time = kick_spread_time
+        self.is_draining = False
+        self.num_to_drain = 0
+        self.num_drained = 0
+        self.drain_task: asyncio.Task = None
+
+        self.commondata_db.create_index("pid")
+
         self.sync_status_from_database()
         self.sync_status_to_database()
 
-    def bind_ranking_manager(self, ranking_mgr: RankingManager):
+    def bind_ranking_manager(self, ranking_mgr: MK8RankingManager):
         self.ranking_mgr = ranking_mgr
 
     @staticmethod
@@ -101,12 +141,49 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
         if api_key != self.api_key:
             await context.abort(grpc.StatusCode.PERMISSION_DENIED, "Bad API key")
 
-    async def kick_all(self) -> int:
-        pids = list(self.rmc_clients.keys())
-        for pid in pids:
-            cl = self.rmc_clients.pop(pid)
-            await cl.disconnect()
-        return len(pids)
+    def start_kick_all(self, spread_time: float = None) -> asyncio.Task:
+        """Starts draining the connected clients in the background, or returns the drain in progress"""
+        if self.drain_task is None or self.drain_task.done():
+            self.drain_task = asyncio.create_task(self.drain_clients(spread_time))
+        return self.drain_task
+
+    async def kick_all(self, spread_time: float = None) -> int:
+        return await asyncio.shield(self.start_kick_all(spread_time))
+
+    async def drain_clients(self, spread_time: float = None) -> int:
+        if spread_time is None:
+            spread_time = self.kick_spread_time
+
+        async with self.rmc_clients_lock:
+            clients = list(self.rmc_clients.values())
+            self.rmc_clients.clear()
+
+        self.is_draining = True
+        self.num_to_drain = len(clients)
+        self.num_drained = 0
+
+        # Spreading the kicks over some time avoids every client reconnecting at the same moment
+        semaphore = asyncio.Semaphore(self.kick_concurrency)
+        delay = (spread_time / len(clients)) if len(clients) > 0 else 0
+
+        async def kick(index: int, cl: rmc.RMCClient):
+            if delay > 0:
+                await asyncio.sleep(index * delay)
+
+            async with semaphore:
+                try:
+                    await cl.disconnect()
+                except Exception:
+                    logger.exception("Couldn't disconnect player %d", cl.pid())
+
+            self.num_drained += 1
+
+        try:
+            await asyncio.gather(*[kick(i, cl) for i, cl in enumerate(clients)])
+        finally:
+            self.is_draining = False
+
+        return len(clients)
 
     async def kick_by_pid(self, pid) -> bool:
         if pid in self.rmc_clients:
@@ -136,6 +213,9 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
             num_clients=len(list(self.rmc_clients)),
             start_maintenance_time=start_maintenance,
             end_maintenance_time=end_maintenance,
+            is_draining=self.is_draining,
+            num_to_drain=self.num_to_drain,
+            num_drained=self.num_drained,
         )
 
     async def StartMaintenance(self,
@@ -232,75 +312,182 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
 
         await self.check_auth(context)
 
-        res = await self.kick_all()
+        # Draining can take a while with a spread time, the progress is reported by GetServerStatus
+        if self.drain_task is not None and not self.drain_task.done():
+            res = self.num_to_drain
+        else:
+            res = len(self.rmc_clients)
+            self.start_kick_all()
 
         return amkj_service_pb2.KickAllUsersResponse(num_kicked=res)
 
+    @staticmethod
+    def gatherings_pipeline(offset: int, limit: int) -> list[dict]:
+        pipeline = [{'$skip': offset}]
+        if limit > 0:
+            pipeline.append({"$limit": limit})
+
+        pipeline.append({
+            "$project": {
+                "attribs": 1,
+                "application_data": 1,
+                "game_mode": 1,
+                "id": 1,
+                "host": 1,
+                "owner": 1,
+                "min_participants": 1,
+                "max_participants": 1,
+                "players": 1
+            }
+        })
+
+        return pipeline
+
+    def get_mii_names(self, pids: list[int]) -> dict[int, str]:
+        names = {}
+        for pid in pids:
+            mii_name = mii_name_cache.get(pid)
+            if mii_name is not None:
+                names[pid] = mii_name
+
+        # Players who aren't cached are looked up all at once
+        missing = [pid for pid in pids if pid not in names]
+        if len(missing) > 0:
+            for data in self.commondata_db.find({"pid": {"$in": missing}}, {"_id": 0, "pid": 1, "mii_name": 1}):
+                mii_name = data["mii_name"] if "mii_name" in data else "<Restart game>"
+                mii_name_cache.set(data["pid"], mii_name)
+                names[data["pid"]] = mii_name
+
+        return names
+
+    def fill_gathering_players(self, gatherings: list[dict]):
+        pids = set()
+        for gathering in gatherings:
+            pids.update(gathering["players"])
+
+        # Same as the former commondata join: participants without common data (including guests) aren't listed
+        names = self.get_mii_names(list(pids))
+        for gathering in gatherings:
+            gathering["players"] = [{"pid": pid, "mii_name": names[pid]} for pid in gathering["players"] if pid in names]
+
+    @staticmethod
+    def gathering_to_proto(gathering: dict) -> amkj_service_pb2.Gathering:
+        attribs = gathering["attribs"] if "attribs" in gathering else []
+        app_data = gathering["application_data"] if "application_data" in gathering else b""
+        game_mode = gathering["game_mode"] if "game_mode" in gathering else 0
+
+        players = []
+        for player in gathering["players"]:
+            mii_name = player["mii_name"] if "mii_name" in player else "<Restart game>"
+            players.append(amkj_service_pb2.GatheringParticipant(pid=player["pid"], mii_name=mii_name))
+
+        return amkj_service_pb2.Gathering(
+            gid=gathering["id"],
+            host=gathering["host"],
+            owner=gathering["owner"],
+            attributes=attribs,
+            game_mode=game_mode,
+            app_data=app_data,
+            players=players,
+            min_participants=gathering["min_participants"],
+            max_participants=gathering["max_participants"]
+        )
+
+    @staticmethod
+    def tournament_to_proto(tournament: dict) -> amkj_service_pb2.Tournament:
+        start_date_time = Timestamp()
+        start_date_time.FromDatetime(common.DateTime(tournament["datetime"]["start_datetime"]).standard_datetime())
+
+        end_date_time = Timestamp()
+        end_date_time.FromDatetime(common.DateTime(tournament["datetime"]["end_datetime"]).standard_datetime())
+
+        return amkj_service_pb2.Tournament(
+            id=tournament["id"],
+            owner=tournament["owner"],
+            attributes=tournament["attributes"],
+            community_code=tournament["community_code"],
+            app_data=tournament["metadata"],
+            total_participants=tournament["total_participants"],
+            season_id=tournament["season_id"],
+            name=tournament["parsed_metadata"]["name"],
+            description=tournament["parsed_metadata"]["description"],
+            red_team=tournament["parsed_metadata"]["red_team"],
+            blue_team=tournament["parsed_metadata"]["blue_team"],
+            repeat_type=tournament["parsed_metadata"]["repeat_type"],
+            gameset_num=tournament["parsed_metadata"]["gameset_num"],
+            icon_type=tournament["parsed_metadata"]["icon_type"],
+            battle_time=tournament["parsed_metadata"]["battle_time"],
+            update_date=tournament["parsed_metadata"]["update_date"],
+            start_day_time=tournament["datetime"]["start_daytime"],
+            end_day_time=tournament["datetime"]["end_daytime"],
+            start_time=tournament["datetime"]["start_time"],
+            end_time=tournament["datetime"]["end_time"],
+            start_date_time=start_date_time,
+            end_date_time=end_date_time
+        )
+
+    @staticmethod
+    def ban_to_proto(restriction: dict) -> amkj_service_pb2.Ban:
+        start_time = Timestamp()
+        start_time.FromDatetime(restriction["start_time"])
+
+        if restriction["end_time"] is not None:
+            end_time = Timestamp()
+            end_time.FromDatetime(restriction["end_time"])
+        else:
+            end_time = None
+
+        return amkj_service_pb2.Ban(
+            pid=restriction["pid"],
+            reason=restriction["reason"],
+            start_time=start_time,
+            end_time=end_time
+        )
+
+    @staticmethod
+    async def iterate_cursor_batches(cursor, batch_size: int):
+        # Fetch one batch at a time off the event loop, the next batch is only read once the client consumed this one
+        if batch_size <= 0:
+            batch_size = DEFAULT_STREAM_BATCH_SIZE
+
+        cursor.batch_size(batch_size)
+        while True:
+            batch = await asyncio.to_thread(lambda: list(itertools.islice(cursor, batch_size)))
+            if len(batch) == 0:
+                break
+
+            yield batch
+
+    @staticmethod
+    async def iterate_cursor(cursor, batch_size: int):
+        async for batch in AmkjService.iterate_cursor_batches(cursor, batch_size):
+            for document in batch:
+                yield document
+
     async def GetAllGatherings(self,
                                request: amkj_service_pb2.GetAllGatheringsRequest,
                                context: grpc.aio.ServicerContext) -> amkj_service_pb2.GetAllGatheringsResponse:
 
         await self.check_auth(context)
 
-        pipeline = [
-            {
-                '$lookup': {
-                    'from': self.commondata_db.name,
-                    'localField': 'players',
-                    'foreignField': 'pid',
-                    'as': 'players'
-                }
-            },
-            {
-                "$project": {
-                    "attribs": 1,
-                    "application_data": 1,
-                    "game_mode": 1,
-                    "id": 1,
-                    "host": 1,
-                    "owner": 1,
-                    "min_participants": 1,
-                    "max_participants": 1,
-                    "players.pid": 1,
-                    "players.mii_name": 1
-                }
-            },
-            {
-                '$skip': request.offset
-            },
-        ]
-
-        if request.limit >= 0:
-            pipeline.append({"$limit": request.limit})
-
-        cursor = self.gatherings_db.aggregate(pipeline)
-
-        gatherings = []
-        for gathering in cursor:
-            attribs = gathering["attribs"] if "attribs" in gathering else []
-            app_data = gathering["application_data"] if "application_data" in gathering else b""
-            game_mode = gathering["game_mode"] if "game_mode" in gathering else 0
-
-            players = []
-            for player in gathering["players"]:
-                mii_name = player["mii_name"] if "mii_name" in player else "<Restart game>"
-                players.append(amkj_service_pb2.GatheringParticipant(pid=player["pid"], mii_name=mii_name))
-
-            gatherings.append(
-                amkj_service_pb2.Gathering(
-                    gid=gathering["id"],
-                    host=gathering["host"],
-                    owner=gathering["owner"],
-                    attributes=attribs,
-                    game_mode=game_mode,
-                    app_data=app_data,
-                    players=players,
-                    min_participants=gathering["min_participants"],
-                    max_participants=gathering["max_participants"]
-                ))
+        gatherings = list(self.gatherings_db.aggregate(self.gatherings_pipeline(request.offset, request.limit)))
+        self.fill_gathering_players(gatherings)
+        gatherings = [self.gathering_to_proto(gathering) for gathering in gatherings]
 
         return amkj_service_pb2.GetAllGatheringsResponse(gatherings=gatherings)
 
+    async def StreamAllGatherings(self,
+                                  request: amkj_service_pb2.StreamAllGatheringsRequest,
+                                  context: grpc.aio.ServicerContext):
+
+        await self.check_auth(context)
+
+        cursor = self.gatherings_db.aggregate(self.gatherings_pipeline(request.offset, request.limit))
+        async for batch in self.iterate_cursor_batches(cursor, request.batch_size):
+            self.fill_gathering_players(batch)
+            for gathering in batch:
+                yield self.gathering_to_proto(gathering)
+
     async def GetAllTournaments(self,
                                 request: amkj_service_pb2.GetAllTournamentsRequest,
                                 context: grpc.aio.ServicerContext) -> amkj_service_pb2.GetAllTournamentsResponse:
@@ -312,52 +499,28 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
         if request.limit > 0:
             cursor = cursor.limit(request.limit)
 
-        tournaments = []
-        for tournament in cursor:
-            start_date_time = Timestamp()
-            start_date_time.FromDatetime(common.DateTime(tournament["datetime"]["start_datetime"]).standard_datetime())
-
-            end_date_time = Timestamp()
-            end_date_time.FromDatetime(common.DateTime(tournament["datetime"]["end_datetime"]).standard_datetime())
-
-            tournaments.append(
-                amkj_service_pb2.Tournament(
-                    id=tournament["id"],
-                    owner=tournament["owner"],
-                    attributes=tournament["attributes"],
-                    community_code=tournament["community_code"],
-                    app_data=tournament["metadata"],
-                    total_participants=tournament["total_participants"],
-                    season_id=tournament["season_id"],
-                    name=tournament["parsed_metadata"]["name"],
-                    description=tournament["parsed_metadata"]["description"],
-                    red_team=tournament["parsed_metadata"]["red_team"],
-                    blue_team=tournament["parsed_metadata"]["blue_team"],
-                    repeat_type=tournament["parsed_metadata"]["repeat_type"],
-                    gameset_num=tournament["parsed_metadata"]["gameset_num"],
-                    icon_type=tournament["parsed_metadata"]["icon_type"],
-                    battle_time=tournament["parsed_metadata"]["battle_time"],
-                    update_date=tournament["parsed_metadata"]["update_date"],
-                    start_day_time=tournament["datetime"]["start_daytime"],
-                    end_day_time=tournament["datetime"]["end_daytime"],
-                    start_time=tournament["datetime"]["start_time"],
-                    end_time=tournament["datetime"]["end_time"],
-                    start_date_time=start_date_time,
-                    end_date_time=end_date_time
-                ))
+        tournaments = [self.tournament_to_proto(tournament) for tournament in cursor]
 
         return amkj_service_pb2.GetAllTournamentsResponse(tournaments=tournaments)
 
-    async def GetUnlocks(self,
-                         request: amkj_service_pb2.GetUnlocksRequest,
-                         context: grpc.aio.ServicerContext) -> amkj_service_pb2.GetUnlocksResponse:
+    async def StreamAllTournaments(self,
+                                   request: amkj_service_pb2.StreamAllTournamentsRequest,
+                                   context: grpc.aio.ServicerContext):
 
         await self.check_auth(context)
 
+        cursor = self.tournaments_db.find({"attributes.0": 1}).skip(request.offset)
+        if request.limit > 0:
+            cursor = cursor.limit(request.limit)
+
+        async for tournament in self.iterate_cursor(cursor, request.batch_size):
+            yield self.tournament_to_proto(tournament)
+
+    @staticmethod
+    def unlocks_to_proto(data: dict | None) -> amkj_service_pb2.GetUnlocksResponse:
         last_update = Timestamp()
         last_update.FromDatetime(datetime.utcnow())
 
-        data = self.commondata_db.find_one({"pid": request.pid})
         if data:
             last_update.FromDatetime(data["last_update"])
             res = amkj_service_pb2.GetUnlocksResponse(
@@ -392,25 +555,32 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
 
         return res
 
-    """
-    message TimeTrialRanking {
-        uint32 rank = 1;
-        google.protobuf.Timestamp datetime = 2;
-        uint32 score = 3;
-        uint32 pid = 4;
-        bytes common_data = 5;
-    }
-
-    message GetTimeTrialRankingRequest {
-        uint32 track = 1;
-        int32 limit = 2;
-        bool asc = 3;
-    }
-
-    message GetTimeTrialRankingResponse {
-        repeated TimeTrialRanking rankings = 1;
-    }
-    """
+    async def GetUnlocks(self,
+                         request: amkj_service_pb2.GetUnlocksRequest,
+                         context: grpc.aio.ServicerContext) -> amkj_service_pb2.GetUnlocksResponse:
+
+        await self.check_auth(context)
+
+        data = self.commondata_db.find_one({"pid": request.pid}, UNLOCKS_PROJECTION)
+        return self.unlocks_to_proto(data)
+
+    async def GetUnlocksBatch(self,
+                              request: amkj_service_pb2.GetUnlocksBatchRequest,
+                              context: grpc.aio.ServicerContext) -> amkj_service_pb2.GetUnlocksBatchResponse:
+
+        await self.check_auth(context)
+
+        pids = list(set(request.pids))
+        if len(pids) > MAX_UNLOCKS_BATCH_SIZE:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Too many PIDs (max %d)" % MAX_UNLOCKS_BATCH_SIZE)
+
+        documents = {}
+        for data in self.commondata_db.find({"pid": {"$in": pids}}, UNLOCKS_PROJECTION):
+            documents[data["pid"]] = data
+
+        # PIDs without common data are still returned, with has_data set to false
+        unlocks = {pid: self.unlocks_to_proto(documents.get(pid)) for pid in pids}
+        return amkj_service_pb2.GetUnlocksBatchResponse(unlocks=unlocks)
 
     async def GetTimeTrialRanking(self,
                                   request: amkj_service_pb2.GetTimeTrialRankingRequest,
@@ -418,16 +588,21 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
 
         await self.check_auth(context)
 
-        rankings = []
-        scores = self.ranking_mgr.get_scores_by_range_standard(request.track, 0, request.limit, not request.asc)
-        for score in scores:
-            rank = list(score.keys())[0]
-            score_data = list(score.values())[0]
+        # Whole rankings are no longer returned in one response, they have to be paged
+        if request.limit <= 0:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "limit must be positive (max %d)" % MAX_TIME_TRIAL_RANKING_PAGE_SIZE)
+
+        limit = min(request.limit, MAX_TIME_TRIAL_RANKING_PAGE_SIZE)
 
-            score = score_data["score"]
-            pid = score_data["pid"]
-            common_data = score_data["data"]
+        with_common_data = not request.omit_common_data
+        if request.HasField("around_pid"):
+            scores, offset, next_offset, has_more = self.ranking_mgr.get_scores_page_around_pid(request.around_pid, request.track, limit, not request.asc, with_common_data)
+        else:
+            offset = request.offset
+            scores, next_offset, has_more = self.ranking_mgr.get_scores_page(request.track, offset, limit, not request.asc, with_common_data)
 
+        rankings = []
+        for rank, score_data in scores:
             entry_time = Timestamp()
             entry_time.FromDatetime(score_data["insert_time"])
 
@@ -435,13 +610,18 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
                 amkj_service_pb2.TimeTrialRanking(
                     rank=rank,
                     datetime=entry_time,
-                    score=score,
-                    pid=pid,
-                    common_data=common_data
+                    score=score_data["score"],
+                    pid=score_data["pid"],
+                    common_data=score_data["data"] if with_common_data else b""
                 )
             )
 
-        return amkj_service_pb2.GetTimeTrialRankingResponse(rankings=rankings)
+        return amkj_service_pb2.GetTimeTrialRankingResponse(
+            rankings=rankings,
+            offset=offset,
+            next_offset=next_offset,
+            has_more=has_more
+        )
 
     async def DeleteTimeTrialRanking(self,
                                      request: amkj_service_pb2.DeleteTimeTrialRankingRequest,
@@ -492,23 +672,48 @@ class AmkjService(amkj_service_pb2_grpc.AmkjServiceServicer):
         if request.limit > 0:
             cursor = cursor.limit(request.limit)
 
-        bans = []
-        for restriction in cursor:
-            start_time = Timestamp()
-            start_time.FromDatetime(restriction["start_time"])
-
-            if restriction["end_time"] is not None:
-                end_time = Timestamp()
-                end_time.FromDatetime(restriction["end_time"])
-            else:
-                end_time = None
-
-            bans.append(
-                amkj_service_pb2.Ban(
-                    pid=restriction["pid"],
-                    reason=restriction["reason"],
-                    start_time=start_time,
-                    end_time=end_time
-                ))
+        bans = [self.ban_to_proto(restriction) for restriction in cursor]
 
         return amkj_service_pb2.GetAllBansResponse(bans=bans)
+
+    async def StreamAllBans(self,
+                            request: amkj_service_pb2.StreamAllBansRequest,
+                            context: grpc.aio.ServicerContext):
+        await self.check_auth(context)
+
+        cursor = self.restrictions_db.find({}).skip(request.offset)
+        if request.limit > 0:
+            cursor = cursor.limit(request.limit)
+
+        async for restriction in self.iterate_cursor(cursor, request.batch_size):
+            yield self.ban_to_proto(restriction)
+
+    async def ConfigureProfiler(self,
+                                request: amkj_service_pb2.ConfigureProfilerRequest,
+                                context: grpc.aio.ServicerContext) -> amkj_service_pb2.ConfigureProfilerResponse:
+        await self.check_auth(context)
+
+        if request.enabled and not profiler.installed:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, "The profiler hooks are only installed when profiler_enabled is set in the config")
+
+        profiler.configure(request.enabled, request.threshold, request.sample_rate)
+        return amkj_service_pb2.ConfigureProfilerResponse()
+
+    async def GetSlowCalls(self,
+                           request: amkj_service_pb2.GetSlowCallsRequest,
+                           context: grpc.aio.ServicerContext) -> amkj_service_pb2.GetSlowCallsResponse:
+        await self.check_auth(context)
+
+        # Most recent first
+        records = list(reversed(profiler.records))
+        if request.limit > 0:
+            records = records[:request.limit]
+
+        calls = []
+        for record in records:
+            call_time = Timestamp()
+            call_time.FromDatetime(datetime.fromisoformat(record["time"]))
+
+            calls.append(amkj_service_pb2.SlowCall(**dict(record, time=call_time)))
+
+        return amkj_service_pb2.GetSlowCallsResponse(calls=calls)
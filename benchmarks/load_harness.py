@@ -0,0 +1,334 @@
+"""
+Load generator for the MK8 protocol servers.
+
+Calls the method implementations of MK8RankingServer, MK8MatchmakeExtensionServer and MK8DataStoreServer
+directly (no PRUDP), with synthetic clients and payloads generated from a fixed seed. MongoDB and Redis
+are in-memory stand-ins (mongomock, fakeredis) unless --mongo-uri / --redis-url are given. S3 is a local
+stand-in that signs URLs for real, or with --local-storage the DataStore objects are written to that directory.
+
+    python -m benchmarks.load_harness --requests 2000 --concurrency 16 --json results.json
+"""
+
+from nintendo.nex import settings, common, ranking, datastore
+from nex_protocols_common_py.secure_connection_protocol import CommonSecureConnectionServer
+from mk8_ranking_protocol import MK8RankingServer, MK8RankingManager, mk8_common_data_handler
+from mk8_matchmake_extension_protocol import MK8MatchmakeExtensionServer
+from mk8_datastore_protocol import MK8DataStoreServer
+from object_storage import LocalObjectStorage
+from benchmarks import payloads
+from benchmarks.stand_ins import BenchmarkClient, LocalMinio, connect_mongo, connect_redis, redis_has_lua
+from typing import Awaitable, Callable
+import argparse
+import asyncio
+import logging
+import random
+import json
+import time
+
+BUCKET_NAME = "benchmark"
+FIRST_PID = 1000000
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Scenario:
+    def __init__(self, name: str, call: Callable[[random.Random], Awaitable]):
+        self.name = name
+        self.call = call
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+
+        nex_settings = settings.default()
+        nex_settings.configure("25dbf96a", 30504)
+
+        mongo_client = connect_mongo(args.mongo_uri)
+        mongo_client.drop_database(args.database)
+        db = mongo_client[args.database]
+
+        self.redis_client = connect_redis(args.redis_url)
+        self.redis_client.flushdb()
+        self.has_lua = redis_has_lua(self.redis_client)
+
+        for counter in [("gathering_id", 1000), ("tournament_id", 20000), ("datastore_object_id", 20000)]:
+            db.sequence.insert_one({"_id": counter[0], "seq": counter[1]})
+
+        self.s3_client = None
+        self.local_storage = None
+        if args.local_storage:
+            self.local_storage = LocalObjectStorage(args.local_storage, "http://127.0.0.1:8380", "benchmark")
+        else:
+            self.s3_client = LocalMinio()
+
+        ranking_mgr = MK8RankingManager(db.rankings, db.commondata, self.redis_client)
+        self.ranking_server = MK8RankingServer(nex_settings,
+                                               rankings_db=db.rankings,
+                                               redis_instance=self.redis_client,
+                                               commondata_db=db.commondata,
+                                               common_data_handler=mk8_common_data_handler,
+                                               rankings_category={},
+                                               tournaments_db=db.tournaments,
+                                               tournaments_scores_db=db.tournaments_scores,
+                                               ranking_mgr=ranking_mgr)
+
+        secure_connection_server = CommonSecureConnectionServer(nex_settings, sessions_db=db.sessions, reportdata_db=db.reports)
+
+        async def get_friend_pids(pid: int) -> list[int]:
+            return []
+
+        self.matchmake_extension_server = MK8MatchmakeExtensionServer(nex_settings,
+                                                                      gatherings_db=db.gatherings,
+                                                                      sequence_db=db.sequence,
+                                                                      get_friend_pids_func=get_friend_pids,
+                                                                      secure_connection_server=secure_connection_server,
+                                                                      tournaments_db=db.tournaments,
+                                                                      matchmaking_batch_window=args.matchmaking_batch_window)
+
+        def calculate_s3_object_key_ex(database, pid, persistence_id: int, object_id: int) -> str:
+            if persistence_id < 1024:
+                return "ghosts/%d/%d.bin" % (pid, persistence_id)
+            else:
+                return "mktv/%d.bin" % (object_id)
+
+        def calculate_s3_object_key(database, client, persistence_id: int, object_id: int) -> str:
+            return calculate_s3_object_key_ex(database, client.pid(), persistence_id, object_id)
+
+        self.datastore_server = MK8DataStoreServer(nex_settings,
+                                                   s3_client=self.s3_client,
+                                                   s3_bucket=BUCKET_NAME,
+                                                   datastore_db=db.datastore,
+                                                   sequence_db=db.sequence,
+                                                   calculate_s3_object_key=calculate_s3_object_key,
+                                                   calculate_s3_object_key_ex=calculate_s3_object_key_ex,
+                                                   storage=self.local_storage)
+
+        self.tournament_ids: list[int] = []
+        self.objects: list[tuple[int, int, int]] = []  # (owner, persistence ID, data ID)
+
+    def random_client(self, rng: random.Random) -> BenchmarkClient:
+        return BenchmarkClient(FIRST_PID + rng.randrange(self.args.players))
+
+    # ============= Ranking =============
+
+    async def upload_common_data(self, rng: random.Random):
+        client = self.random_client(rng)
+        await self.ranking_server.upload_common_data(client, payloads.make_common_data(rng, "Player%d" % client.pid()), 0)
+
+    async def upload_score(self, rng: random.Random):
+        score_data = ranking.RankingScoreData()
+        score_data.category = rng.randrange(self.args.categories)
+        score_data.score = rng.randrange(60000, 300000)
+        score_data.order = 0
+        score_data.update_mode = 1
+        score_data.groups = [rng.randrange(256), rng.randrange(256)]
+        score_data.param = 0
+        await self.ranking_server.upload_score(self.random_client(rng), score_data, 0)
+
+    def ranking_order(self, rng: random.Random, order_calc: int) -> ranking.RankingOrderParam:
+        order = ranking.RankingOrderParam()
+        order.order_calc = order_calc
+        order.offset = rng.randrange(100)
+        order.count = 20
+        return order
+
+    async def get_ranking_standard(self, rng: random.Random):
+        await self.ranking_server.get_ranking(self.random_client(rng), ranking.RankingMode.GLOBAL,
+                                              rng.randrange(self.args.categories), self.ranking_order(rng, 0), 0, 0)
+
+    async def get_ranking_ordinal(self, rng: random.Random):
+        await self.ranking_server.get_ranking(self.random_client(rng), ranking.RankingMode.GLOBAL,
+                                              rng.randrange(self.args.categories), self.ranking_order(rng, 1), 0, 0)
+
+    async def get_ranking_around_self(self, rng: random.Random):
+        await self.ranking_server.get_ranking(self.random_client(rng), ranking.RankingMode.GLOBAL_AROUND_SELF,
+                                              rng.randrange(self.args.categories), self.ranking_order(rng, 1), 0, 0)
+
+    # ============= Matchmake extension =============
+
+    async def create_simple_search_object(self, rng: random.Random):
+        tournament_id = await self.matchmake_extension_server.create_simple_search_object(self.random_client(rng), payloads.make_simple_search_object(rng))
+        self.tournament_ids.append(tournament_id)
+
+    async def search_simple_search_object(self, rng: random.Random):
+        await self.matchmake_extension_server.search_simple_search_object(self.random_client(rng), payloads.make_simple_search_param(rng))
+
+    async def search_simple_search_object_by_object_ids(self, rng: random.Random):
+        ids = [rng.choice(self.tournament_ids) for _ in range(20)] if self.tournament_ids else [0]
+        await self.matchmake_extension_server.search_simple_search_object_by_object_ids(self.random_client(rng), ids)
+
+    async def auto_matchmake(self, rng: random.Random):
+        session = payloads.make_matchmake_session(rng)
+        num_players = rng.choice([1, 1, 1, 2])
+        await self.matchmake_extension_server.auto_matchmake_with_search_criteria_postpone(
+            self.random_client(rng), payloads.make_search_criteria(session, num_players), session, "")
+
+    # ============= DataStore =============
+
+    async def post_object(self, rng: random.Random):
+        client = self.random_client(rng)
+        size = rng.randrange(0x1000, 0x20000)
+        persistence_id = rng.randrange(48)
+
+        info = await self.datastore_server.prepare_post_object(client, payloads.make_prepare_post_param(rng, persistence_id, size))
+        key = "ghosts/%d/%d.bin" % (client.pid(), persistence_id)
+        if self.local_storage:
+            await self.local_storage.put_object(key, bytes(size))
+        else:
+            self.s3_client.upload(key, size)
+
+        param = datastore.DataStoreCompletePostParam()
+        param.data_id = info.data_id
+        param.success = True
+        await self.datastore_server.complete_post_object(client, param)
+
+        # Posting to a used persistence slot replaces the object that was there
+        self.objects = [obj for obj in self.objects if obj[:2] != (client.pid(), persistence_id)]
+        self.objects.append((client.pid(), persistence_id, info.data_id))
+
+    async def prepare_get_object(self, rng: random.Random):
+        # Ghosts are downloaded by owner and persistence ID
+        owner, persistence_id, data_id = rng.choice(self.objects)
+        param = datastore.DataStorePrepareGetParam()
+        param.persistence_target.owner_id = owner
+        param.persistence_target.persistence_id = persistence_id
+        await self.datastore_server.prepare_get_object(self.random_client(rng), param)
+
+    async def get_object_infos(self, rng: random.Random):
+        ids = [rng.choice(self.objects)[2] for _ in range(10)]
+        await self.datastore_server.get_object_infos(self.random_client(rng), ids)
+
+    async def search_object(self, rng: random.Random):
+        await self.datastore_server.search_object(self.random_client(rng), payloads.make_search_param(rng))
+
+    async def change_meta(self, rng: random.Random):
+        owner, persistence_id, data_id = rng.choice(self.objects)
+        await self.datastore_server.change_meta(BenchmarkClient(owner), payloads.make_change_meta_param(rng, data_id))
+
+    async def change_metas(self, rng: random.Random):
+        owner = rng.choice(self.objects)[0]
+        data_ids = [data_id for pid, persistence_id, data_id in self.objects if pid == owner][:10]
+        params = [payloads.make_change_meta_param(rng, data_id) for data_id in data_ids]
+        await self.datastore_server.change_metas(BenchmarkClient(owner), data_ids, params, False)
+
+    # ============= Runner =============
+
+    def scenarios(self) -> list[Scenario]:
+        # Writes first, so the reads that follow have data to work on
+        scenarios = [
+            Scenario("ranking.upload_common_data", self.upload_common_data),
+            Scenario("ranking.upload_score", self.upload_score),
+            Scenario("ranking.get_ranking_ordinal", self.get_ranking_ordinal),
+            Scenario("ranking.get_ranking_around_self", self.get_ranking_around_self),
+        ]
+        if self.has_lua:
+            scenarios.append(Scenario("ranking.get_ranking_standard", self.get_ranking_standard))
+
+        scenarios += [
+            Scenario("matchmake.create_simple_search_object", self.create_simple_search_object),
+            Scenario("matchmake.search_simple_search_object", self.search_simple_search_object),
+            Scenario("matchmake.search_simple_search_object_by_object_ids", self.search_simple_search_object_by_object_ids),
+            Scenario("matchmake.auto_matchmake", self.auto_matchmake),
+            Scenario("datastore.post_object", self.post_object),
+            Scenario("datastore.prepare_get_object", self.prepare_get_object),
+            Scenario("datastore.get_object_infos", self.get_object_infos),
+            Scenario("datastore.search_object", self.search_object),
+            Scenario("datastore.change_meta", self.change_meta),
+            Scenario("datastore.change_metas", self.change_metas),
+        ]
+
+        if self.args.only:
+            scenarios = [scenario for scenario in scenarios if any(name in scenario.name for name in self.args.only)]
+        return scenarios
+
+    async def run_scenario(self, scenario: Scenario) -> dict:
+        # One generator per scenario, so adding or filtering scenarios doesn't change the payloads of the others
+        rng = random.Random("%d:%s" % (self.args.seed, scenario.name))
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+        errors: dict[str, int] = {}
+
+        async def call(measure: bool):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await scenario.call(rng)
+                except common.RMCError as e:
+                    errors[e.name()] = errors.get(e.name(), 0) + 1
+                except Exception as e:
+                    errors[e.__class__.__name__] = errors.get(e.__class__.__name__, 0) + 1
+                if measure:
+                    latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*[call(False) for _ in range(self.args.warmup)])
+
+        start = time.perf_counter()
+        await asyncio.gather(*[call(True) for _ in range(self.args.requests)])
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        return {
+            "name": scenario.name,
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p90_ms": percentile(latencies, 0.90) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        }
+
+    async def run(self) -> list[dict]:
+        results = []
+        for scenario in self.scenarios():
+            results.append(await self.run_scenario(scenario))
+        return results
+
+
+def print_results(results: list[dict]):
+    print("%-52s %8s %10s %9s %9s %9s %9s  %s" % ("method", "requests", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "errors"))
+    for res in results:
+        errors = ", ".join("%s=%d" % item for item in sorted(res["errors"].items()))
+        print("%-52s %8d %10.1f %9.3f %9.3f %9.3f %9.3f  %s" % (res["name"], res["requests"], res["throughput"],
+                                                             res["p50_ms"], res["p90_ms"], res["p99_ms"], res["max_ms"], errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the MK8 protocol servers")
+    parser.add_argument("--requests", type=int, default=1000, help="Measured calls per method")
+    parser.add_argument("--warmup", type=int, default=100, help="Unmeasured calls per method before measuring")
+    parser.add_argument("--concurrency", type=int, default=16, help="Calls in flight at the same time")
+    parser.add_argument("--players", type=int, default=500, help="Number of synthetic players")
+    parser.add_argument("--categories", type=int, default=32, help="Number of ranking categories (tracks) used")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--matchmaking-batch-window", type=float, default=0.0)
+    parser.add_argument("--mongo-uri", default="", help="Use this MongoDB server instead of mongomock")
+    parser.add_argument("--database", default="mk8_benchmark", help="Database dropped and used by the benchmark")
+    parser.add_argument("--redis-url", default="", help="Use this Redis server instead of fakeredis (the database is flushed)")
+    parser.add_argument("--local-storage", help="Keep the DataStore objects in this directory instead of the S3 stand-in")
+    parser.add_argument("--only", nargs="*", help="Only run the methods whose name contains one of these")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    harness = Harness(args)
+    if not harness.has_lua:
+        print("The Redis server doesn't run Lua scripts, skipping the standard ranking (install lupa for fakeredis)\n")
+
+    results = asyncio.run(harness.run())
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
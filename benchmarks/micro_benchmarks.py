@@ -0,0 +1,114 @@
+"""
+CPU cost of the parsers and converters that run on every request, timed with timeit on seeded payloads.
+
+    python -m benchmarks.micro_benchmarks --save baseline.json
+    python -m benchmarks.micro_benchmarks --baseline baseline.json --max-slowdown 1.25
+
+With --baseline, the exit code is 1 when a benchmark is slower than its baseline time by more than
+--max-slowdown, so it can gate a CI job. Baselines are only comparable on the same machine.
+"""
+
+from nintendo.nex import streams, settings
+from mk8_ranking_protocol import mk8_common_data_handler
+from mk8_datastore_protocol import MK8DataStoreSearchParam
+from simple_search_object_utils import ChunkData, TournamentMetadata, get_query_filters_from_search_conditions, \
+    simple_search_object_to_document, simple_search_object_from_document
+from benchmarks import payloads
+from benchmarks.stand_ins import NullCollection
+from typing import Callable
+import argparse
+import random
+import timeit
+import json
+import sys
+
+
+def make_benchmarks(seed: int) -> dict[str, Callable]:
+    rng = random.Random(seed)
+    nex_settings = settings.default()
+    nex_settings.configure("25dbf96a", 30504)
+
+    collection = NullCollection()
+    common_data = payloads.make_common_data(rng, "Benchmark")
+
+    metadata = payloads.make_tournament_metadata(rng)
+    search_object = payloads.make_simple_search_object(rng)
+    search_object_document = simple_search_object_to_document(search_object)
+    conditions = payloads.make_simple_search_param(rng).conditions
+
+    search_param = payloads.make_search_param(rng)
+    search_param.owner_ids = [rng.randrange(1000000, 2000000) for _ in range(10)]
+    search_param.tags = ["track%d" % rng.randrange(48)]
+    stream = streams.StreamOut(nex_settings)
+    stream.add(search_param)
+    search_param_data = stream.get()
+
+    def save_search_param():
+        stream = streams.StreamOut(nex_settings)
+        stream.add(search_param)
+        return stream.get()
+
+    return {
+        "mk8_common_data_handler": lambda: mk8_common_data_handler(collection, 1000000, common_data, 0),
+        "ChunkData.parse": lambda: ChunkData(metadata).parse(),
+        "TournamentMetadata.parse": lambda: TournamentMetadata(metadata).parse(),
+        "get_query_filters_from_search_conditions": lambda: get_query_filters_from_search_conditions(conditions),
+        "simple_search_object_to_document": lambda: simple_search_object_to_document(search_object),
+        "simple_search_object_from_document": lambda: simple_search_object_from_document(search_object_document),
+        "MK8DataStoreSearchParam.load": lambda: streams.StreamIn(search_param_data, nex_settings).extract(MK8DataStoreSearchParam),
+        "MK8DataStoreSearchParam.save": save_search_param,
+    }
+
+
+def measure(func: Callable, repeat: int, min_time: float) -> float:
+    """Best time per call in microseconds, over repeat runs of at least min_time seconds each"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the request parsers and converters")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum duration of one run, in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="Only run the benchmarks whose name contains one of these")
+    parser.add_argument("--save", help="Write the results to this file, to use as a baseline")
+    parser.add_argument("--baseline", help="Compare against the results saved in this file")
+    parser.add_argument("--max-slowdown", type=float, default=1.25, help="Allowed time ratio over the baseline")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = []
+    print("%-45s %12s %12s %8s" % ("benchmark", "us/call", "baseline", "ratio"))
+    for name, func in make_benchmarks(args.seed).items():
+        if args.only and not any(part in name for part in args.only):
+            continue
+
+        results[name] = measure(func, args.repeat, args.min_time)
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            print("%-45s %12.3f %12.3f %8.2f%s" % (name, results[name], baseline[name], ratio,
+                                                   "  REGRESSION" if ratio > args.max_slowdown else ""))
+            if ratio > args.max_slowdown:
+                regressions.append(name)
+        else:
+            print("%-45s %12.3f %12s %8s" % (name, results[name], "-", "-"))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": sys.version, "results": results}, f, indent=4)
+
+    if regressions:
+        print("\n%d benchmark(s) more than %.2fx slower than the baseline: %s" % (len(regressions), args.max_slowdown, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
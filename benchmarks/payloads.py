@@ -0,0 +1,173 @@
+from nintendo.nex import common, matchmaking, matchmaking_mk8d, datastore
+from mk8_datastore_protocol import MK8DataStoreSearchParam, MK8DataStoreChangeMetaParam
+import random
+import struct
+
+# Synthetic payloads with the same layout and sizes as the ones sent by the game
+
+
+def make_common_data(rng: random.Random, mii_name: str) -> bytes:
+    """Ranking common data (0xd4 bytes), as parsed by mk8_common_data_handler"""
+    header = struct.pack(">III", rng.getrandbits(32), rng.getrandbits(32), rng.getrandbits(32))
+    rates = struct.pack(">ff", rng.uniform(1000, 9999), rng.uniform(1000, 9999))
+
+    mii_values = [ord(c) for c in mii_name[:10]]
+    mii_values += [0] * (10 - len(mii_values))
+    account_related_data = bytes(rng.getrandbits(8) for _ in range(0x1a)) + struct.pack("<10H", *mii_values)
+    account_related_data += bytes(rng.getrandbits(8) for _ in range(0x60 - len(account_related_data)))
+
+    misc = struct.pack(">BBxxIII", rng.getrandbits(8), rng.getrandbits(8), rng.getrandbits(32), rng.getrandbits(32), rng.getrandbits(32))
+    open_flag_pack = bytes(rng.getrandbits(8) for _ in range(0x3f))
+
+    data = header + rates + account_related_data + misc + open_flag_pack
+    return data + bytes(0xd4 - len(data))
+
+
+def make_chunk(chunk_id: int, data: bytes) -> bytes:
+    return struct.pack(">BH", chunk_id, len(data)) + data
+
+
+def make_tournament_metadata(rng: random.Random) -> bytes:
+    """Tournament metadata chunks, as parsed by TournamentMetadata"""
+    def text(value: str) -> bytes:
+        return (value + "\0").encode("utf-16be")
+
+    data = struct.pack(">H", 0x5a5a)
+    data += make_chunk(0, struct.pack(">B", 1))
+    data += make_chunk(1, struct.pack(">I", 3))
+    data += make_chunk(2, text("Tournament %d" % rng.randrange(100000)))
+    data += make_chunk(3, struct.pack(">B", rng.randrange(8)))
+    data += make_chunk(4, text("Benchmark tournament with a description of a realistic length " * 2))
+    data += make_chunk(5, struct.pack(">I", rng.randrange(3)))
+    data += make_chunk(6, struct.pack(">I", rng.randrange(1, 9)))
+    data += make_chunk(7, text("Red team"))
+    data += make_chunk(8, text("Blue team"))
+    data += make_chunk(9, struct.pack(">I", rng.randrange(60)))
+    data += make_chunk(10, b"")
+    data += make_chunk(11, struct.pack(">I", rng.getrandbits(32)))
+    data += struct.pack(">B", 255)
+    return data
+
+
+def make_simple_search_object(rng: random.Random) -> matchmaking_mk8d.SimpleSearchObject:
+    obj = matchmaking_mk8d.SimpleSearchObject()
+    obj.id = 0
+    obj.owner = 0
+    obj.attributes = [1, rng.randrange(4), rng.randrange(6), rng.randrange(1, 9), rng.choice([1, 2]), rng.choice([1, 2, 3]),
+                      rng.choice([1, 2]), rng.choice([1, 2]), rng.randrange(1, 10), rng.randrange(5), rng.choice([1, 2]),
+                      rng.choice([1, 2, 3, 4]), 1, 1, 0, 0, 0, 0, 0, 0]
+    obj.metadata = make_tournament_metadata(rng)
+    obj.community_id = rng.randrange(1, 0xffffffff)
+    obj.community_code = "".join(rng.choice("0123456789") for _ in range(12))
+    obj.datetime = matchmaking_mk8d.SimpleSearchDateTimeAttribute()
+    obj.datetime.start_daytime = 0
+    obj.datetime.end_daytime = 0
+    obj.datetime.start_time = 0
+    obj.datetime.end_time = 0
+    obj.datetime.start_datetime = common.DateTime.make(2024, 1, 1)
+    obj.datetime.end_datetime = common.DateTime.make(2030, 1, 1)
+    obj.unk3 = 0
+    obj.unk4 = 0
+    return obj
+
+
+def make_simple_search_param(rng: random.Random) -> matchmaking_mk8d.SimpleSearchParam:
+    param = matchmaking_mk8d.SimpleSearchParam()
+    for value, operator in [(1, 1), (0, 0), (rng.randrange(6), 5), (rng.randrange(1, 9), 4)]:
+        condition = matchmaking_mk8d.SimpleSearchCondition()
+        condition.value = value
+        condition.operator = operator
+        param.conditions.append(condition)
+
+    # The game always sends one condition per attribute, unused ones have operator 0
+    for i in range(len(param.conditions), 20):
+        condition = matchmaking_mk8d.SimpleSearchCondition()
+        condition.value = 0
+        condition.operator = 0
+        param.conditions.append(condition)
+
+    param.range.offset = 0
+    param.range.size = 20
+    return param
+
+
+def make_matchmake_session(rng: random.Random) -> matchmaking.MatchmakeSession:
+    session = matchmaking.MatchmakeSession()
+    session.min_participants = 1
+    session.max_participants = 12
+    session.game_mode = rng.choice([0, 1])
+    session.attribs = [0, rng.randrange(4), 0, rng.randrange(3), rng.choice([0, 1]), 0]
+    session.application_data = bytes(rng.getrandbits(8) for _ in range(0x50))
+    return session
+
+
+def make_search_criteria(session: matchmaking.MatchmakeSession, num_players: int) -> list[matchmaking.MatchmakeSessionSearchCriteria]:
+    criteria = matchmaking.MatchmakeSessionSearchCriteria()
+    criteria.attribs = [str(value) for value in session.attribs]
+    criteria.game_mode = str(session.game_mode)
+    criteria.min_participants = "1,1"
+    criteria.max_participants = "12,12"
+    criteria.vacant_participants = num_players
+    return [criteria]
+
+
+def make_prepare_post_param(rng: random.Random, persistence_id: int, size: int) -> datastore.DataStorePreparePostParam:
+    param = datastore.DataStorePreparePostParam()
+    param.size = size
+    param.name = "ghost"
+    param.data_type = rng.randrange(1, 8)
+    param.meta_binary = bytes(rng.getrandbits(8) for _ in range(0x40))
+    param.flag = 0
+    param.period = 90
+    param.tags = ["track%d" % rng.randrange(48)]
+    param.persistence_init_param.persistence_id = persistence_id
+    param.extra_data = []
+
+    rating = datastore.DataStoreRatingInitParamWithSlot()
+    rating.slot = 0
+    rating.param.flag = 0
+    rating.param.initial_value = 0
+    rating.param.range_min = 0
+    rating.param.range_max = 0x7fffffff
+    rating.param.lock_type = 0
+    rating.param.lock_param = 0
+    rating.param.period_hour = 0
+    rating.param.period_duration = 0
+    param.rating_init_param = [rating]
+    return param
+
+
+def make_search_param(rng: random.Random) -> MK8DataStoreSearchParam:
+    param = MK8DataStoreSearchParam()
+    param.data_type = rng.randrange(1, 8)
+    param.result_order_column = 5
+    param.result_order = 1  # Newest first
+    param.result_range.offset = 0
+    param.result_range.size = 20
+    param.result_option = 4
+    return param
+
+
+def make_change_meta_param(rng: random.Random, data_id: int) -> MK8DataStoreChangeMetaParam:
+    param = MK8DataStoreChangeMetaParam()
+    param.data_id = data_id
+    param.modifies_flag = 0x10
+    param.name = ""
+    param.period = 0
+    param.meta_binary = bytes(rng.getrandbits(8) for _ in range(0x40))
+    param.tags = []
+    param.update_password = 0
+    param.referred_count = 0
+    param.data_type = 0
+    param.status = 0
+
+    # Nothing is compared, the fields are still written
+    param.compare_param.comparison_flag = 0
+    param.compare_param.name = ""
+    param.compare_param.period = 0
+    param.compare_param.meta_binary = b""
+    param.compare_param.tags = []
+    param.compare_param.referred_count = 0
+    param.compare_param.data_type = 0
+    param.compare_param.status = 0
+    return param
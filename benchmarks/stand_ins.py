@@ -0,0 +1,95 @@
+from minio import Minio
+from minio.credentials import StaticProvider
+from minio.error import S3Error
+import urllib3
+import pymongo
+import redis
+
+# Local stand-ins for the services the NEX server talks to, so benchmarks run without any infrastructure
+
+
+class BenchmarkClient:
+    """The parts of RMCClient used by the protocol method implementations"""
+
+    def __init__(self, pid: int):
+        self._pid = pid
+
+    def pid(self) -> int:
+        return self._pid
+
+
+class ObjectStat:
+    def __init__(self, size: int, etag: str):
+        self.size = size
+        self.etag = etag
+
+
+class LocalMinio(Minio):
+    """
+    MinIO client that signs URLs and POST policies for real (no network is needed when the region is set)
+    but keeps the uploaded objects in memory, clients upload directly to the bucket so only their size matters.
+    """
+
+    def __init__(self):
+        super().__init__(endpoint="localhost:9000", secure=False, region="us-east-1",
+                         credentials=StaticProvider("benchmark", "benchmark-secret", ""))
+        self.objects: dict[str, tuple[int, str]] = {}  # Key -> size, MD5
+
+    def upload(self, key: str, size: int, etag: str = ""):
+        self.objects[key] = (size, etag or "%032x" % hash((key, size)))
+
+    def stat_object(self, bucket_name: str, object_name: str, *args, **kwargs):
+        if object_name not in self.objects:
+            raise S3Error(urllib3.HTTPResponse(status=404), "NoSuchKey", "Object does not exist", object_name, "", "",
+                          bucket_name=bucket_name, object_name=object_name)
+        return ObjectStat(*self.objects[object_name])
+
+    def remove_object(self, bucket_name: str, object_name: str, *args, **kwargs):
+        self.objects.pop(object_name, None)
+
+
+def connect_mongo(mongo_uri: str):
+    if mongo_uri:
+        return pymongo.MongoClient(mongo_uri, serverSelectionTimeoutMS=3000)
+
+    import mongomock
+    patch_mongomock_bulk_update(mongomock)
+    return mongomock.MongoClient()
+
+
+def patch_mongomock_bulk_update(mongomock):
+    # pymongo >= 4.11 passes the sort of UpdateOne to the bulk builder, which mongomock doesn't take yet.
+    # The server never sorts its bulk updates, so dropping it changes nothing
+    builder = mongomock.collection.BulkOperationBuilder
+    add_update = builder.add_update
+    if getattr(add_update, "drops_sort", False):
+        return
+
+    def add_update_without_sort(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+
+    add_update_without_sort.drops_sort = True
+    builder.add_update = add_update_without_sort
+
+
+def connect_redis(redis_url: str) -> redis.Redis:
+    if redis_url:
+        return redis.from_url(redis_url)
+
+    import fakeredis
+    return fakeredis.FakeRedis()
+
+
+def redis_has_lua(redis_client: redis.Redis) -> bool:
+    # fakeredis only runs scripts when lupa is installed, the standard ranking needs one
+    try:
+        return redis_client.eval("return 1", 0) == 1
+    except Exception:
+        return False
+
+
+class NullCollection:
+    """Collection that drops writes, to time document building without the database"""
+
+    def find_one_and_replace(self, filter, replacement, *args, **kwargs):
+        return None
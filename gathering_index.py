@@ -0,0 +1,168 @@
+from nintendo.nex import matchmaking
+from pymongo.collection import Collection
+
+
+def parse_participants_condition(value: str) -> tuple[int, int] | None:
+    if value == "":
+        return None
+
+    if ',' in value:
+        low, high = value.split(",")
+        return int(low), int(high)
+
+    return int(value), int(value)
+
+
+class GatheringIndex:
+    """
+    In-memory index of the MK8 matchmake sessions, bucketed by (tournament ID, region, DLC flag)
+    then by number of free slots, so auto-matchmaking doesn't have to scan the gatherings collection.
+
+    The database stays the source of truth: every gathering returned here must be re-checked
+    when joining it, and is refreshed (or evicted) from the document read at that time.
+    """
+
+    def __init__(self):
+        self.buckets: dict[tuple[int, int, int], dict[int, dict[int, dict]]] = {}
+        self.entries: dict[int, dict] = {}
+        self.player_gatherings: dict[int, set[int]] = {}
+
+    @staticmethod
+    def bucket_key(attribs: list[int]) -> tuple[int, int, int]:
+        return (attribs[0], attribs[3], attribs[4])  # Tournament ID, region, DLC status
+
+    @staticmethod
+    def free_slots(entry: dict) -> int:
+        return entry["max_participants"] - len(entry["players"])
+
+    def load(self, gatherings_db: Collection):
+        self.buckets.clear()
+        self.entries.clear()
+        self.player_gatherings.clear()
+
+        cursor = gatherings_db.find({"type": "MatchmakeSession"}, {
+            "id": 1,
+            "attribs": 1,
+            "game_mode": 1,
+            "min_participants": 1,
+            "max_participants": 1,
+            "participation_policy": 1,
+            "players": 1,
+        })
+        for gathering in cursor:
+            self.update(gathering)
+
+    def update(self, gathering: dict):
+        """Insert or refresh a gathering from its (up-to-date) database document"""
+        self.remove(gathering["id"])
+
+        if gathering.get("type", "MatchmakeSession") != "MatchmakeSession":
+            return
+
+        if len(gathering["attribs"]) < 5:
+            return
+
+        # Empty matchmake sessions get deleted (see matchmaking_utils.handle_gathering_player_removal)
+        if len(gathering["players"]) == 0:
+            return
+
+        entry = {
+            "id": gathering["id"],
+            "attribs": list(gathering["attribs"]),
+            "game_mode": gathering["game_mode"],
+            "min_participants": gathering["min_participants"],
+            "max_participants": gathering["max_participants"],
+            "participation_policy": gathering["participation_policy"],
+            "players": list(gathering["players"]),
+        }
+
+        free_slots = self.free_slots(entry)
+        self.buckets.setdefault(self.bucket_key(entry["attribs"]), {}).setdefault(free_slots, {})[entry["id"]] = entry
+        self.entries[entry["id"]] = entry
+
+        for pid in entry["players"]:
+            self.player_gatherings.setdefault(abs(pid), set()).add(entry["id"])
+
+    def remove(self, gid: int):
+        entry = self.entries.pop(gid, None)
+        if not entry:
+            return
+
+        key = self.bucket_key(entry["attribs"])
+        bucket = self.buckets[key]
+        free_slots = self.free_slots(entry)
+        del bucket[free_slots][gid]
+        if len(bucket[free_slots]) == 0:
+            del bucket[free_slots]
+        if len(bucket) == 0:
+            del self.buckets[key]
+
+        for pid in entry["players"]:
+            gids = self.player_gatherings.get(abs(pid))
+            if gids is not None:
+                gids.discard(gid)
+                if len(gids) == 0:
+                    del self.player_gatherings[abs(pid)]
+
+    def remove_player(self, pid: int):
+        for gid in list(self.player_gatherings.get(pid, [])):
+            entry = self.entries[gid]
+            players = [player for player in entry["players"] if abs(player) != pid]
+            if len(players) == 0:
+                self.remove(gid)
+            else:
+                self.update(dict(entry, players=players))
+
+    def find(self, pid: int, attribs: list[int], game_mode: int,
+             min_participants: tuple[int, int] | None, max_participants: tuple[int, int] | None,
+             num_players: int, limit: int) -> list[int]:
+
+        bucket = self.buckets.get(self.bucket_key(attribs))
+        if not bucket:
+            return []
+
+        res = []
+
+        # Fill the fullest gatherings first, so that rooms start as soon as possible
+        for free_slots in sorted(bucket.keys()):
+            if free_slots < num_players:
+                continue
+
+            for entry in bucket[free_slots].values():
+                if entry["game_mode"] != game_mode:
+                    continue
+
+                if min_participants and not (min_participants[0] <= entry["min_participants"] <= min_participants[1]):
+                    continue
+
+                if max_participants and not (max_participants[0] <= entry["max_participants"] <= max_participants[1]):
+                    continue
+
+                if pid in entry["players"]:
+                    continue
+
+                res.append(entry["id"])
+                if len(res) >= limit:
+                    return res
+
+        return res
+
+    def find_for_search_criteria(self, pid: int,
+                                 search_criteria: list[matchmaking.MatchmakeSessionSearchCriteria],
+                                 gathering: matchmaking.MatchmakeSession,
+                                 limit: int) -> list[int]:
+        """Same matching rules as matchmaking_utils.find_gathering, without hitting the database"""
+        if (search_criteria) and (len(search_criteria) > 0):
+            res = []
+            for sc in search_criteria:
+                game_mode = int(sc.game_mode) if sc.game_mode != "" else gathering.game_mode
+                res += self.find(pid, gathering.attribs, game_mode,
+                                 parse_participants_condition(sc.min_participants),
+                                 parse_participants_condition(sc.max_participants),
+                                 sc.vacant_participants, limit)
+            return res
+
+        return self.find(pid, gathering.attribs, gathering.game_mode,
+                         (gathering.min_participants, gathering.min_participants),
+                         (gathering.max_participants, gathering.max_participants),
+                         1, limit)
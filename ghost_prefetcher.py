@@ -0,0 +1,81 @@
+from mk8_ranking_protocol import MK8RankingServer
+from mk8_datastore_protocol import MK8DataStoreServer
+from typing import Callable
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class GhostPrefetcher:
+    """
+    Warms the download path of the ghosts at the top of the time trial leaderboards. Categories whose
+    scores changed are collected by the ranking manager listener, and every interval seconds the presigned URLs
+    of their top ghosts are signed ahead of time (and their contents cached, if the storage serves downloads).
+    """
+
+    def __init__(self,
+                 ranking_server: MK8RankingServer,
+                 datastore_server: MK8DataStoreServer,
+                 get_ghost_persistence_id: Callable[[int], int | None],
+                 top_count: int,
+                 interval: float):
+        self.ranking_server = ranking_server
+        self.datastore_server = datastore_server
+        self.get_ghost_persistence_id = get_ghost_persistence_id
+        self.top_count = top_count
+        self.interval = interval
+
+        self.dirty_categories: set[int] = set()
+
+        ranking_server.ranking_mgr.score_listeners.append(self.mark_dirty)
+
+    def mark_dirty(self, category: int):
+        if self.get_ghost_persistence_id(category) is not None:
+            self.dirty_categories.add(category)
+
+    def find_top_ghosts(self, category: int) -> list[dict]:
+        persistence_id = self.get_ghost_persistence_id(category)
+        desc = self.ranking_server.is_category_ordered_desc(category)
+        pids = self.ranking_server.ranking_mgr.get_top_pids(category, self.top_count, desc)
+        if len(pids) == 0:
+            return []
+
+        # Same object as prepare_get_object on (owner, persistence ID): the newest one if the slot has several
+        ghosts = {}
+        for ghost in self.datastore_server.datastore_db.find(
+                {"owner": {"$in": pids}, "persistence_id": persistence_id},
+                {"_id": 0, "id": 1, "owner": 1, "persistence_id": 1, "storage_key": 1},
+                sort=[("create_time", -1)]):
+            ghosts.setdefault(ghost["owner"], ghost)
+
+        return list(ghosts.values())
+
+    async def warm_category(self, category: int):
+        ghosts = await asyncio.to_thread(self.find_top_ghosts, category)
+
+        storage = self.datastore_server.storage
+        for ghost in ghosts:
+            key = self.datastore_server.get_object_key(ghost)
+            self.datastore_server.url_cache.get_url(key)
+
+            # Uploads drop the cached contents of their key, so a cached ghost is always the current one
+            if storage.blob_cache is None or storage.blob_cache.contains(key):
+                continue
+
+            version = storage.blob_cache.version
+            data = await storage.get_object(key)
+            if data is not None:
+                storage.blob_cache.set(key, data, version)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            categories = self.dirty_categories
+            self.dirty_categories = set()
+            for category in categories:
+                try:
+                    await self.warm_category(category)
+                except Exception:
+                    logger.exception("Failed to prefetch the ghosts of category %d", category)
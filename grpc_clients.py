@@ -0,0 +1,158 @@
+import asyncio
+import secrets
+import struct
+import time
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import grpc
+from grpc_py.account import account_service_pb2_grpc
+from grpc_py.account.get_nex_password_rpc_pb2 import GetNEXPasswordRequest
+from grpc_py.friends import friends_service_pb2_grpc
+from grpc_py.friends.get_user_friend_pids_rpc_pb2 import GetUserFriendPIDsRequest
+from ttl_cache import TTLCache
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FriendsClient:
+    """Async client for the friends gRPC service, with a per-PID friend list cache"""
+
+    def __init__(self, host: str, port: int, api_key: str, cache_ttl: float, cache_size: int, timeout: float, max_concurrent_requests: int = 16):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.channel = grpc.aio.insecure_channel('%s:%d' % (host, port))
+        self.stub = friends_service_pb2_grpc.FriendsStub(self.channel)
+
+        self.cache = TTLCache(cache_ttl, cache_size)
+        self.requests_semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    async def get_friend_pids(self, pid: int) -> list[int]:
+        pids = self.cache.get(pid)
+        if pids is not None:
+            return pids
+
+        async with self.requests_semaphore:
+            response = await self.stub.GetUserFriendPIDs(GetUserFriendPIDsRequest(pid=pid),
+                                                         metadata=[("x-api-key", self.api_key)],
+                                                         timeout=self.timeout)
+
+        pids = list(response.pids)
+        self.cache.set(pid, pids)
+        return pids
+
+    async def prefetch_friend_pids(self, pids: list[int]):
+        # Guest players are stored as -PID in gatherings, they don't have a friend list of their own
+        missing = [pid for pid in set(pids) if pid > 0 and not self.cache.contains(pid)]
+        results = await asyncio.gather(*[self.get_friend_pids(pid) for pid in missing], return_exceptions=True)
+        for pid, result in zip(missing, results):
+            if isinstance(result, Exception):
+                logger.warning("Couldn't prefetch the friend list of %d: %s", pid, result)
+
+    async def close(self):
+        await self.channel.close()
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for a while after too many consecutive errors"""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.num_failures = 0
+        self.opened_at = None
+
+    def is_open(self) -> bool:
+        if self.opened_at is None:
+            return False
+
+        # Once the timeout is over, a single request is let through: it closes the breaker again if it succeeds,
+        # and the others wait for another timeout in case it never finishes
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            self.opened_at = now
+            return False
+
+        return True
+
+    def record_success(self):
+        self.num_failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.num_failures += 1
+        if self.num_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class AccountClient:
+    """
+    Async client for the account gRPC service, used to fetch NEX passwords on login.
+
+    Passwords are cached for a short time, encrypted with AES-GCM under a per-process key so they never sit
+    in memory as plain text, and concurrent lookups for the same PID share a single request.
+    """
+
+    def __init__(self, host: str, port: int, api_key: str, cache_ttl: float, cache_size: int, timeout: float,
+                 breaker_failure_threshold: int, breaker_reset_timeout: float):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.channel = grpc.aio.insecure_channel('%s:%d' % (host, port))
+        self.stub = account_service_pb2_grpc.AccountStub(self.channel)
+
+        self.cache = TTLCache(cache_ttl, cache_size)
+        self.cipher = AESGCM(AESGCM.generate_key(bit_length=256))
+        self.pending_requests: dict[int, asyncio.Future] = {}
+        self.breaker = CircuitBreaker(breaker_failure_threshold, breaker_reset_timeout)
+
+    def seal(self, pid: int, password: str) -> tuple[bytes, bytes]:
+        # The PID is authenticated with the password, so an entry can't be read back under another PID
+        nonce = secrets.token_bytes(12)
+        return nonce, self.cipher.encrypt(nonce, password.encode("utf-8"), struct.pack("<Q", pid))
+
+    def unseal(self, pid: int, sealed: tuple[bytes, bytes]) -> str:
+        nonce, data = sealed
+        return self.cipher.decrypt(nonce, data, struct.pack("<Q", pid)).decode("utf-8")
+
+    def get_cached_nex_password(self, pid: int) -> str:
+        sealed = self.cache.get(pid)
+        if sealed is None:
+            raise KeyError("No NEX password cached for %d" % pid)
+        return self.unseal(pid, sealed)
+
+    async def get_nex_password(self, pid: int) -> str:
+        sealed = self.cache.get(pid)
+        if sealed is not None:
+            return self.unseal(pid, sealed)
+
+        # Concurrent logins of the same PID wait for the same request
+        future = self.pending_requests.get(pid)
+        if future is None:
+            future = asyncio.ensure_future(self.request_nex_password(pid))
+            self.pending_requests[pid] = future
+            future.add_done_callback(lambda _: self.pending_requests.pop(pid, None))
+
+        return await asyncio.shield(future)
+
+    async def request_nex_password(self, pid: int) -> str:
+        if self.breaker.is_open():
+            raise ConnectionError("Account service circuit breaker is open")
+
+        try:
+            response = await self.stub.GetNEXPassword(GetNEXPasswordRequest(pid=pid),
+                                                      metadata=[("x-api-key", self.api_key)],
+                                                      timeout=self.timeout)
+        except grpc.aio.AioRpcError as e:
+            # Unknown accounts are a normal answer, only count the service being unreachable or slow
+            if e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.INTERNAL):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+
+        self.breaker.record_success()
+        self.cache.set(pid, self.seal(pid, response.password))
+        return response.password
+
+    async def close(self):
+        await self.channel.close()
@@ -0,0 +1,133 @@
+from logging.handlers import QueueHandler, QueueListener
+import threading
+import logging
+import queue
+import json
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most max_per_interval records per message template (logger + format string)
+    every interval seconds, then one record in sample_every. As every RMC method logs its own
+    template, this limits each method separately. A timer thread writes one summary line per interval
+    listing the templates that went over the limit with their total and suppressed counts.
+    """
+
+    def __init__(self, max_per_interval: int, interval: float, sample_every: int = 0):
+        super().__init__()
+        self.max_per_interval = max_per_interval
+        self.interval = interval
+        self.sample_every = sample_every
+        self.counts: dict[tuple[str, str], list[int]] = {}  # (logger, template) -> [total, suppressed]
+        self.interval_start = time.monotonic()
+        self.lock = threading.Lock()
+        self.summary_logger = logging.getLogger("log_stats")
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="log-stats", daemon=True)
+        self.thread.start()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Summaries and errors always go through
+        if record.name == self.summary_logger.name or record.levelno >= logging.WARNING:
+            return True
+
+        with self.lock:
+            key = (record.name, str(record.msg))
+            entry = self.counts.get(key)
+            if entry is None:
+                entry = [0, 0]
+                self.counts[key] = entry
+
+            entry[0] += 1
+            over_limit = entry[0] - self.max_per_interval
+            allowed = over_limit <= 0 or (self.sample_every > 0 and over_limit % self.sample_every == 0)
+            if not allowed:
+                entry[1] += 1
+
+        return allowed
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            now = time.monotonic()
+            summary = self.make_summary(now - self.interval_start)
+            self.counts = {}
+            self.interval_start = now
+
+        if summary:
+            self.summary_logger.info(summary)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+    def make_summary(self, elapsed: float) -> str | None:
+        suppressed = [(key, entry) for key, entry in self.counts.items() if entry[1] > 0]
+        if len(suppressed) == 0:
+            return None
+
+        suppressed.sort(key=lambda item: item[1][0], reverse=True)
+        parts = ["%s %r: %d (%d suppressed)" % (name, template, entry[0], entry[1]) for (name, template), entry in suppressed]
+        return "Rate limited logs over the last %.0fs: %s" % (elapsed, "; ".join(parts))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(document)
+
+
+class LogListener(QueueListener):
+    def __init__(self, log_queue, handler: logging.Handler, rate_limit_filter: RateLimitFilter | None):
+        super().__init__(log_queue, handler, respect_handler_level=True)
+        self.rate_limit_filter = rate_limit_filter
+
+    def stop(self):
+        # The last summary goes through the queue, so it must be written before the listener stops
+        if self.rate_limit_filter is not None:
+            self.rate_limit_filter.stop()
+        super().stop()
+
+
+def setup_logging(level: str, json_format: bool, rate_limit: int, rate_interval: float, sample_every: int = 0) -> LogListener:
+    """
+    Logs are handed to a queue and written to stderr by a background thread, so handlers never block on I/O.
+    Returns the started listener, stop it on exit to flush the remaining records.
+    """
+
+    stream_handler = logging.StreamHandler()
+    if json_format:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    rate_limit_filter = None
+    if rate_limit > 0:
+        rate_limit_filter = RateLimitFilter(rate_limit, rate_interval, sample_every)
+        queue_handler.addFilter(rate_limit_filter)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener = LogListener(log_queue, stream_handler, rate_limit_filter)
+    listener.start()
+    return listener
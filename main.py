@@ -1,38 +1,39 @@
 # ============= Importing necessary libraries =============
 
+from startup import StartupTimer, StartupError, ReadinessCheck, in_thread, wait_ready
+import time
+
+startup_timer = StartupTimer(time.perf_counter())  # Imports are part of the startup time
+
 from nintendo.nex import rmc, kerberos, common
 import logging
 import asyncio
-import time
-import aioconsole
 import contextlib
-import datetime
-import requests
+import atexit
 
 from datetime import datetime, timezone
 
-from nex_protocols_common_py.authentication_protocol import AuthenticationUser, CommonAuthenticationServer
-from nex_protocols_common_py.secure_connection_protocol import CommonSecureConnectionServer
-from nex_protocols_common_py.matchmaking_protocol import CommonMatchMakingServer
+from nex_protocols_common_py.authentication_protocol import AuthenticationUser
 from nex_protocols_common_py.nat_traversal_protocol import CommonNATTraversalServer
-from nex_protocols_common_py.matchmaking_ext_protocol import CommonMatchMakingServerExt
+from mk8_authentication_protocol import MK8AuthenticationServer
+from mk8_secure_connection_protocol import MK8SecureConnectionServer
 from mk8_matchmake_extension_protocol import MK8MatchmakeExtensionServer
-from mk8_ranking_protocol import MK8RankingServer, mk8_common_data_handler
+from mk8_matchmaking_ext_protocol import MK8MatchmakingServerExt
+from mk8_matchmaking_protocol import MK8MatchmakingServer
+from mk8_ranking_protocol import MK8RankingServer, MK8RankingManager, mk8_common_data_handler
 from mk8_datastore_protocol import MK8DataStoreServer
 
 import grpc
 from amkj_service import AmkjService, amkj_service_pb2_grpc
-from grpc_py.account import account_service_pb2_grpc
-from grpc_py.account.get_nex_password_rpc_pb2 import GetNEXPasswordRequest
-from grpc_py.friends import friends_service_pb2_grpc
-from grpc_py.friends.get_user_friend_pids_rpc_pb2 import GetUserFriendPIDsRequest
+from grpc_clients import AccountClient, FriendsClient
+from metrics import metrics
+from profiler import profiler
+from logging_setup import setup_logging
 
 import redis
+import pymongo
 
-from minio import Minio
-from minio.datatypes import PostPolicy
-from minio.credentials import StaticProvider
-from io import BytesIO
+from object_storage import create_s3_client, S3ObjectStorage, LocalObjectStorage
 
 try:
     from server_config import NEX_CONFIG, NEX_SETTINGS
@@ -41,48 +42,80 @@ except ModuleNotFoundError as e:
     exit(-1)
 
 
-logging.basicConfig(level=logging.INFO)
+log_listener = setup_logging(NEX_CONFIG.log_level, NEX_CONFIG.log_json, NEX_CONFIG.log_rate_limit, NEX_CONFIG.log_rate_interval,
+                             NEX_CONFIG.log_sample_every)
+atexit.register(log_listener.stop)
+startup_timer.record("imports", startup_timer.start)
 
 # ============= Connecting to the database =============
 
-GameDatabase = NEX_CONFIG.game_db_server.connect()[NEX_CONFIG.game_database]
-
-# ============= Main server program =============
-
-amkj_service = AmkjService(NEX_CONFIG.mario_kart_8_grpc_api_key,
-                           GameDatabase["status"],
-                           GameDatabase[NEX_CONFIG.gatherings_collection],
-                           GameDatabase[NEX_CONFIG.tournaments_collection],
-                           GameDatabase[NEX_CONFIG.ranking_common_data_collection],
-                           GameDatabase[NEX_CONFIG.restriction_collection],)
+if NEX_CONFIG.metrics_port != 0:
+    metrics.register_mongo_listener()
 
-friends_grpc_client = grpc.insecure_channel('%s:%d' % (NEX_CONFIG.friends_grpc_host, NEX_CONFIG.friends_grpc_port))
-friends_service = friends_service_pb2_grpc.FriendsStub(friends_grpc_client)
-
-account_grpc_client = grpc.insecure_channel('%s:%d' % (NEX_CONFIG.account_grpc_host, NEX_CONFIG.account_grpc_port))
-account_service = account_service_pb2_grpc.AccountStub(account_grpc_client)
-
-redis_client = redis.from_url(NEX_CONFIG.redis_uri)
-redis_client.ping()
-
-s3_client = Minio(endpoint=NEX_CONFIG.s3_endpoint_domain,
-                  secure=True,
-                  credentials=StaticProvider(NEX_CONFIG.s3_access_key, NEX_CONFIG.s3_secret, ""))
+# The profiler hooks add a wrapper to every RMC call, so they are only installed when it is enabled in the config
+profiler.configure(NEX_CONFIG.profiler_enabled, NEX_CONFIG.profiler_threshold, NEX_CONFIG.profiler_sample_rate)
+if NEX_CONFIG.profiler_enabled:
+    profiler.register_mongo_listener()
+if NEX_CONFIG.profiler_log_file:
+    profiler.set_log_file(NEX_CONFIG.profiler_log_file, NEX_CONFIG.profiler_log_max_bytes, NEX_CONFIG.profiler_log_backup_count)
 
+GameDatabase = NEX_CONFIG.game_db_server.connect()[NEX_CONFIG.game_database]
 
-def mk8_get_friend_pids(pid: int) -> list[int]:
-    response = friends_service.GetUserFriendPIDs(GetUserFriendPIDsRequest(pid=pid), metadata=[("x-api-key", NEX_CONFIG.friends_grpc_api_key)])
-    pids = [pids for pids in response.pids]
-    return pids
+# ============= Main server program =============
 
+# Created once the database is known to be reachable, see init()
+amkj_service: AmkjService = None
+
+redis_client = redis.from_url(NEX_CONFIG.redis_uri, socket_connect_timeout=NEX_CONFIG.startup_check_timeout)
+
+if NEX_CONFIG.metrics_port != 0:
+    metrics.instrument_redis(redis_client)
+if NEX_CONFIG.profiler_enabled:
+    profiler.instrument_redis(redis_client)
+
+if NEX_CONFIG.storage_backend == "local":
+    s3_client = None
+    object_storage = LocalObjectStorage(NEX_CONFIG.local_storage_root,
+                                        public_url=NEX_CONFIG.local_storage_public_url,
+                                        secret=NEX_CONFIG.local_storage_secret,
+                                        cache_max_bytes=NEX_CONFIG.ghost_cache_max_bytes)
+else:
+    s3_client = create_s3_client(endpoint=NEX_CONFIG.s3_endpoint_domain,
+                                 access_key=NEX_CONFIG.s3_access_key,
+                                 secret=NEX_CONFIG.s3_secret,
+                                 region=NEX_CONFIG.s3_region,
+                                 max_connections=NEX_CONFIG.s3_max_connections,
+                                 timeout=NEX_CONFIG.s3_timeout)
+    object_storage = S3ObjectStorage(s3_client, NEX_CONFIG.bucket_name, max_workers=NEX_CONFIG.s3_max_connections)
+
+
+def check_s3_bucket():
+    if not s3_client.bucket_exists(NEX_CONFIG.bucket_name):
+        raise StartupError("Bucket %s does not exist" % NEX_CONFIG.bucket_name)
+
+
+async def check_grpc_service(host: str, port: int):
+    async with grpc.aio.insecure_channel("%s:%d" % (host, port)) as channel:
+        await channel.channel_ready()
+
+
+async def wait_for_services():
+    # None of these depend on each other, so a restart waits for the slowest one instead of all of them in turn
+    checks = [
+        ReadinessCheck("MongoDB", in_thread(GameDatabase.client.admin.command, "ping")),
+        ReadinessCheck("Redis", in_thread(redis_client.ping)),
+        # Logins and friend rooms already degrade when these are down, they only need to be reported
+        ReadinessCheck("account service", lambda: check_grpc_service(NEX_CONFIG.account_grpc_host, NEX_CONFIG.account_grpc_port), required=False),
+        ReadinessCheck("friends service", lambda: check_grpc_service(NEX_CONFIG.friends_grpc_host, NEX_CONFIG.friends_grpc_port), required=False),
+    ]
+    if s3_client is not None:
+        checks.append(ReadinessCheck("S3", in_thread(check_s3_bucket)))
 
-def mk8_get_nex_password(pid: int) -> str:
-    response = account_service.GetNEXPassword(GetNEXPasswordRequest(pid=pid), metadata=[("x-api-key", NEX_CONFIG.account_grpc_api_key)])
-    return response.password
+    await wait_ready(checks, NEX_CONFIG.startup_check_timeout)
 
 
 def mk8_auth_callback(auth_user: AuthenticationUser) -> common.Result:
-    if amkj_service.is_maintenance:
+    if amkj_service.is_maintenance or amkj_service.is_draining:
         return common.Result.error("Authentication::UnderMaintenance")
     if amkj_service.is_whitelist and (auth_user.pid not in amkj_service.whitelist):
         return common.Result.error("RendezVous::PermissionDenied")
@@ -116,6 +149,10 @@ async def serve_rmc_custom(settings, servers, host="", port=0, vport=1, context=
         host, port = client.remote_address()
         rmc.logger.debug("New RMC connection: %s:%i", host, port)
 
+        if amkj_service.is_draining:
+            await client.close()
+            return
+
         client = ExtendedRMCClient(settings, client)
         async with client:
             await client.start(servers)
@@ -132,33 +169,53 @@ async def main():
     # ============= Initializing our counter sequences =============
 
     counters = [("gathering_id", 1000), ("tournament_id", 20000), ("datastore_object_id", 20000)]
-    for counter in counters:
-        GameDatabase[NEX_CONFIG.sequence_collection].find_one_and_update(
-            {"_id": counter[0]}, {"$setOnInsert": {"_id": counter[0], "seq": counter[1]}}, upsert=True)
+    with startup_timer.phase("counters"):
+        GameDatabase[NEX_CONFIG.sequence_collection].bulk_write([
+            pymongo.UpdateOne({"_id": counter[0]}, {"$setOnInsert": {"_id": counter[0], "seq": counter[1]}}, upsert=True)
+            for counter in counters
+        ], ordered=False)
 
     # ============= Initializing Authentication Protocol =============
 
+    servers_begin = time.perf_counter()
+
     SecureServerUser = AuthenticationUser(2, "Quazal Rendez-Vous", NEX_CONFIG.nex_secure_user_password)
     GuestUser = AuthenticationUser(100, "guest", "MMQea3n!fsik")
 
-    AuthenticationServer = CommonAuthenticationServer(sett,
-                                                      secure_host=NEX_CONFIG.nex_external_address,
-                                                      secure_port=NEX_CONFIG.nex_secure_port,
-                                                      build_string="Pretendo MK8 server",
-                                                      special_users=[SecureServerUser, GuestUser],
-                                                      get_nex_password_func=mk8_get_nex_password,
-                                                      auth_callback=mk8_auth_callback)
+    account_client = AccountClient(NEX_CONFIG.account_grpc_host,
+                                   NEX_CONFIG.account_grpc_port,
+                                   NEX_CONFIG.account_grpc_api_key,
+                                   cache_ttl=NEX_CONFIG.nex_password_cache_ttl,
+                                   cache_size=NEX_CONFIG.nex_password_cache_size,
+                                   timeout=NEX_CONFIG.grpc_client_timeout,
+                                   breaker_failure_threshold=NEX_CONFIG.account_breaker_failure_threshold,
+                                   breaker_reset_timeout=NEX_CONFIG.account_breaker_reset_timeout)
+
+    AuthenticationServer = MK8AuthenticationServer(sett,
+                                                   secure_host=NEX_CONFIG.nex_external_address,
+                                                   secure_port=NEX_CONFIG.nex_secure_port,
+                                                   build_string="Pretendo MK8 server",
+                                                   special_users=[SecureServerUser, GuestUser],
+                                                   get_nex_password_func=account_client.get_cached_nex_password,
+                                                   fetch_nex_password_func=account_client.get_nex_password,
+                                                   auth_callback=mk8_auth_callback)
 
     # ============= Initializing Secure Protocol =============
 
-    GameDatabase[NEX_CONFIG.sessions_collection].delete_many({})  # Clear all remaining sessions
+    SecureConnectionServer = MK8SecureConnectionServer(sett,
+                                                       sessions_db=GameDatabase[NEX_CONFIG.sessions_collection],
+                                                       reportdata_db=GameDatabase[NEX_CONFIG.secure_reports_collection],
+                                                       instance_id=NEX_CONFIG.instance_id,
+                                                       session_ttl=NEX_CONFIG.session_ttl)
 
-    SecureConnectionServer = CommonSecureConnectionServer(sett,
-                                                          sessions_db=GameDatabase[NEX_CONFIG.sessions_collection],
-                                                          reportdata_db=GameDatabase[NEX_CONFIG.secure_reports_collection])
+    # Removes the sessions left by the previous run of this instance in the background, then keeps ours alive
+    sessions_task = asyncio.create_task(SecureConnectionServer.run())
 
     # ============= Initializing Ranking Protocol =============
 
+    ranking_mgr = MK8RankingManager(GameDatabase[NEX_CONFIG.rankings_score_collection],
+                                    GameDatabase[NEX_CONFIG.ranking_common_data_collection],
+                                    redis_client)
     RankingServer = MK8RankingServer(sett,
                                      rankings_db=GameDatabase[NEX_CONFIG.rankings_score_collection],
                                      redis_instance=redis_client,
@@ -166,22 +223,33 @@ async def main():
                                      common_data_handler=mk8_common_data_handler,
                                      rankings_category={},
                                      tournaments_db=GameDatabase[NEX_CONFIG.tournaments_collection],
-                                     tournaments_scores_db=GameDatabase[NEX_CONFIG.tournaments_score_collection])
+                                     tournaments_scores_db=GameDatabase[NEX_CONFIG.tournaments_score_collection],
+                                     ranking_mgr=ranking_mgr)
 
     # ============= Initializing Matchmake Extension Protocol =============
 
+    friends_client = FriendsClient(NEX_CONFIG.friends_grpc_host,
+                                   NEX_CONFIG.friends_grpc_port,
+                                   NEX_CONFIG.friends_grpc_api_key,
+                                   cache_ttl=NEX_CONFIG.friends_cache_ttl,
+                                   cache_size=NEX_CONFIG.friends_cache_size,
+                                   timeout=NEX_CONFIG.grpc_client_timeout)
+
     MatchmakeExtensionServer = MK8MatchmakeExtensionServer(sett,
                                                            gatherings_db=GameDatabase[NEX_CONFIG.gatherings_collection],
                                                            sequence_db=GameDatabase[NEX_CONFIG.sequence_collection],
-                                                           get_friend_pids_func=mk8_get_friend_pids,
+                                                           get_friend_pids_func=friends_client.get_friend_pids,
                                                            secure_connection_server=SecureConnectionServer,
-                                                           tournaments_db=GameDatabase[NEX_CONFIG.tournaments_collection])
+                                                           tournaments_db=GameDatabase[NEX_CONFIG.tournaments_collection],
+                                                           matchmaking_batch_window=NEX_CONFIG.matchmaking_batch_window,
+                                                           prefetch_friend_pids_func=friends_client.prefetch_friend_pids)
 
     # ============= Initializing Matchmaking Ext Protocol =============
 
-    MatchmakingExtServer = CommonMatchMakingServerExt(sett,
-                                                      gatherings_db=GameDatabase[NEX_CONFIG.gatherings_collection],
-                                                      sequence_db=GameDatabase[NEX_CONFIG.sequence_collection])
+    MatchmakingExtServer = MK8MatchmakingServerExt(sett,
+                                                   gatherings_db=GameDatabase[NEX_CONFIG.gatherings_collection],
+                                                   sequence_db=GameDatabase[NEX_CONFIG.sequence_collection],
+                                                   gathering_index=MatchmakeExtensionServer.gathering_index)
 
     # ============= Initializing NAT Traversal Protocol =============
 
@@ -191,10 +259,11 @@ async def main():
 
     # ============= Initializing Matchmaking Protocol =============
 
-    MatchmakingServer = CommonMatchMakingServer(sett,
-                                                gatherings_db=GameDatabase[NEX_CONFIG.gatherings_collection],
-                                                sessions_db=GameDatabase[NEX_CONFIG.sessions_collection],
-                                                sequence_db=GameDatabase[NEX_CONFIG.sequence_collection])
+    MatchmakingServer = MK8MatchmakingServer(sett,
+                                             gatherings_db=GameDatabase[NEX_CONFIG.gatherings_collection],
+                                             sessions_db=GameDatabase[NEX_CONFIG.sessions_collection],
+                                             sequence_db=GameDatabase[NEX_CONFIG.sequence_collection],
+                                             gathering_index=MatchmakeExtensionServer.gathering_index)
 
     # ============= Initializing DataStore Protocol  =============
 
@@ -216,7 +285,14 @@ async def main():
                                          datastore_db=GameDatabase[NEX_CONFIG.datastore_collection],
                                          sequence_db=GameDatabase[NEX_CONFIG.sequence_collection],
                                          calculate_s3_object_key=mk8_calculate_s3_object_key,
-                                         calculate_s3_object_key_ex=mk8_calculate_s3_object_key_ex)
+                                         calculate_s3_object_key_ex=mk8_calculate_s3_object_key_ex,
+                                         url_lifetime=NEX_CONFIG.s3_url_lifetime,
+                                         url_reuse_time=NEX_CONFIG.s3_url_reuse_time,
+                                         url_cache_size=NEX_CONFIG.s3_url_cache_size,
+                                         storage=object_storage,
+                                         info_cache_size=NEX_CONFIG.datastore_info_cache_size)
+
+    startup_timer.record("protocol servers", servers_begin)
 
     # ============= Creating our RMC server =============
 
@@ -235,18 +311,58 @@ async def main():
 
     amkj_service.bind_ranking_manager(RankingServer.ranking_mgr)
 
+    ghost_prefetch_task = None
+    if NEX_CONFIG.ghost_prefetch_count > 0:
+        from ghost_prefetcher import GhostPrefetcher
+
+        # The game uploads its time trial scores in the category of the course ID, and its ghost in the persistence
+        # slot of that same course ID. It downloads the ghost of a leaderboard entry with PrepareGetObject on
+        # (PID of the entry, course ID), which is the lookup done here. Slots from 1024 on are MKTV highlights.
+        def mk8_ghost_persistence_id(category: int) -> int | None:
+            return category if category < 1024 else None
+
+        ghost_prefetcher = GhostPrefetcher(RankingServer,
+                                           DataStoreServer,
+                                           get_ghost_persistence_id=mk8_ghost_persistence_id,
+                                           top_count=NEX_CONFIG.ghost_prefetch_count,
+                                           interval=NEX_CONFIG.ghost_prefetch_interval)
+        ghost_prefetch_task = asyncio.create_task(ghost_prefetcher.run())
+
+    # ============= Exposing metrics =============
+
+    if NEX_CONFIG.profiler_enabled:
+        for server in auth_servers + secure_servers:
+            profiler.instrument_server(server)
+
+    if NEX_CONFIG.metrics_port != 0:
+        for server in auth_servers + secure_servers:
+            metrics.instrument_server(server)
+
+        await metrics.serve(NEX_CONFIG.metrics_host, NEX_CONFIG.metrics_port)
+
+    if isinstance(object_storage, LocalObjectStorage):
+        await object_storage.serve(NEX_CONFIG.local_storage_host, NEX_CONFIG.local_storage_port)
+
     server_key = kerberos.KeyDerivationOld(65000, 1024).derive_key(NEX_CONFIG.nex_secure_user_password.encode("ascii"), pid=2)
-    async with rmc.serve(sett, auth_servers, NEX_CONFIG.nex_host, NEX_CONFIG.nex_auth_port):
-        async with serve_rmc_custom(sett, secure_servers, NEX_CONFIG.nex_host, NEX_CONFIG.nex_secure_port, key=server_key):
-            server = grpc.aio.server(options=(("grpc.primary_user_agent", "Pretendo_MK8_GRPC"),))
-            amkj_service_pb2_grpc.add_AmkjServiceServicer_to_server(amkj_service, server)
+    try:
+        async with rmc.serve(sett, auth_servers, NEX_CONFIG.nex_host, NEX_CONFIG.nex_auth_port):
+            async with serve_rmc_custom(sett, secure_servers, NEX_CONFIG.nex_host, NEX_CONFIG.nex_secure_port, key=server_key):
+                server = grpc.aio.server(options=(("grpc.primary_user_agent", "Pretendo_MK8_GRPC"),))
+                amkj_service_pb2_grpc.add_AmkjServiceServicer_to_server(amkj_service, server)
+
+                listen_addr = "%s:%d" % (NEX_CONFIG.mario_kart_8_grpc_host, NEX_CONFIG.mario_kart_8_grpc_port)
+                server.add_insecure_port(listen_addr)
+                logging.info("Starting gRPC amkj server on %s", listen_addr)
 
-            listen_addr = "%s:%d" % (NEX_CONFIG.mario_kart_8_grpc_host, NEX_CONFIG.mario_kart_8_grpc_port)
-            server.add_insecure_port(listen_addr)
-            logging.info("Starting gRPC amkj server on %s", listen_addr)
+                await server.start()
+                startup_timer.finish()
 
-            await server.start()
-            await aioconsole.ainput("Press enter to exit...\n")
+                import aioconsole  # Only needed once the server is up
+                await aioconsole.ainput("Press enter to exit...\n")
+    finally:
+        sessions_task.cancel()
+        if ghost_prefetch_task:
+            ghost_prefetch_task.cancel()
 
 
 async def sync_amkj_status_to_database(task: asyncio.Task):
@@ -260,10 +376,10 @@ async def sync_amkj_status_to_database(task: asyncio.Task):
             last_time = time.time()
 
             if amkj_service.is_maintenance == False and amkj_service.should_switch_to_maintenance == True:
-                if datetime.datetime.utcnow() > amkj_service.start_maintenance_time:
+                if datetime.utcnow() > amkj_service.start_maintenance_time:
                     amkj_service.is_maintenance = True
                     amkj_service.should_switch_to_maintenance = False
-                    await amkj_service.kick_all()
+                    amkj_service.start_kick_all()  # Don't block the status loop while draining
 
         await asyncio.sleep(0.1)
 
@@ -273,6 +389,21 @@ async def sync_amkj_status_to_database(task: asyncio.Task):
 
 
 async def init():
+    global amkj_service
+
+    with startup_timer.phase("readiness checks"):
+        await wait_for_services()
+
+    with startup_timer.phase("AMKJ service"):
+        amkj_service = AmkjService(NEX_CONFIG.mario_kart_8_grpc_api_key,
+                                   GameDatabase["status"],
+                                   GameDatabase[NEX_CONFIG.gatherings_collection],
+                                   GameDatabase[NEX_CONFIG.tournaments_collection],
+                                   GameDatabase[NEX_CONFIG.ranking_common_data_collection],
+                                   GameDatabase[NEX_CONFIG.restriction_collection],
+                                   kick_concurrency=NEX_CONFIG.kick_concurrency,
+                                   kick_spread_time=NEX_CONFIG.kick_spread_time)
+
     main_task = asyncio.create_task(main())
     sync_task = asyncio.create_task(sync_amkj_status_to_database(main_task))
 
@@ -0,0 +1,158 @@
+from nintendo.nex import matchmaking
+from pymongo import ReturnDocument
+import nex_protocols_common_py.matchmaking_utils as matchmaking_utils
+from gathering_index import GatheringIndex
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class MatchmakeRequest:
+    def __init__(self, client, search_criteria: list[matchmaking.MatchmakeSessionSearchCriteria], gathering, num_players: int):
+        self.client = client
+        self.search_criteria = search_criteria
+        self.gathering = gathering
+        self.num_players = num_players
+        self.future = asyncio.get_running_loop().create_future()
+
+    def pid_list(self) -> list[int]:
+        # Same layout as matchmaking_utils.add_user_to_gathering_ex (extra local players are stored as -PID)
+        return [self.client.pid()] + [-self.client.pid()] * (self.num_players - 1)
+
+
+class MatchmakingScheduler:
+    """
+    Buffers auto-matchmaking requests for a short window per (tournament ID, region, DLC flag) bucket,
+    then assigns the whole batch to gatherings at once, with a single guarded update per gathering.
+
+    Requests that couldn't be placed by the batch (the gathering changed under us) are handed
+    back to the caller, which then goes through the regular one-by-one matchmaking path.
+    """
+
+    def __init__(self, gatherings_db, sequence_db, gathering_index: GatheringIndex, window: float):
+        self.gatherings_db = gatherings_db
+        self.sequence_db = sequence_db
+        self.gathering_index = gathering_index
+        self.window = window
+
+        self.pending: dict[tuple[int, int, int], list[MatchmakeRequest]] = {}
+        self.flush_handles: dict[tuple[int, int, int], asyncio.TimerHandle] = {}
+
+        self.num_batches = 0
+        self.num_batched_requests = 0
+        self.num_fallbacks = 0
+
+    async def submit(self, client, search_criteria: list[matchmaking.MatchmakeSessionSearchCriteria], gathering, num_players: int):
+        """Returns the joined gathering, or None if the request must be matchmade individually"""
+        key = GatheringIndex.bucket_key(gathering.attribs)
+
+        request = MatchmakeRequest(client, search_criteria, gathering, num_players)
+        self.pending.setdefault(key, []).append(request)
+        if key not in self.flush_handles:
+            self.flush_handles[key] = asyncio.get_running_loop().call_later(self.window, self.flush, key)
+
+        return await request.future
+
+    def flush(self, key: tuple[int, int, int]):
+        self.flush_handles.pop(key, None)
+        requests = self.pending.pop(key, [])
+        if len(requests) == 0:
+            return
+
+        self.num_batches += 1
+        self.num_batched_requests += len(requests)
+
+        try:
+            self.assign(requests)
+        except Exception as e:
+            logger.exception("Batched matchmaking failed")
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+    def assign(self, requests: list[MatchmakeRequest]):
+        plans: dict[int, list[MatchmakeRequest]] = {}
+        try:
+            self.assign_planned(requests, plans)
+        except Exception:
+            # Don't leave the slots reserved by this batch in the index, the database has the real player lists
+            self.resync_gatherings(list(plans.keys()))
+            raise
+
+    def assign_planned(self, requests: list[MatchmakeRequest], plans: dict[int, list[MatchmakeRequest]]):
+        # Plan the whole batch in memory: reserving slots in the index makes the next requests see them as taken
+        for request in requests:
+            if request.future.cancelled():
+                continue
+
+            gid = self.find_planned_gathering(request)
+            if gid is None:
+                created = matchmaking_utils.create_gathering(self.gatherings_db, self.sequence_db, request.client, request.gathering)
+                created_doc = matchmaking_utils.gathering_type_to_document(created)
+                created_doc.update({"players": []})
+                self.gathering_index.update(dict(created_doc, players=request.pid_list()))
+                gid = created.id
+            else:
+                entry = self.gathering_index.entries[gid]
+                self.gathering_index.update(dict(entry, players=entry["players"] + request.pid_list()))
+
+            plans.setdefault(gid, []).append(request)
+
+        # Then one write per gathering for all the players assigned to it
+        for gid, gid_requests in plans.items():
+            pid_list = []
+            for request in gid_requests:
+                pid_list += request.pid_list()
+
+            gathering = self.gatherings_db.find_one_and_update({
+                "id": gid,
+                "players": {"$nin": [request.client.pid() for request in gid_requests]},
+                "$expr": {"$lte": [{"$add": [{"$size": "$players"}, len(pid_list)]}, "$max_participants"]}
+            }, {
+                "$push": {"players": {"$each": pid_list}},
+                "$inc": {"num_participants": len(pid_list)}
+            }, return_document=ReturnDocument.AFTER)
+
+            if gathering:
+                self.gathering_index.update(gathering)
+                res = matchmaking_utils.gathering_type_from_document(gathering)
+                for request in gid_requests:
+                    if not request.future.done():
+                        request.future.set_result(res)
+                continue
+
+            # The gathering was filled or deleted in the meantime, resync it and let these players retry alone
+            self.resync_gatherings([gid])
+
+            self.num_fallbacks += len(gid_requests)
+            for request in gid_requests:
+                if not request.future.done():
+                    request.future.set_result(None)
+
+    def resync_gatherings(self, gids: list[int]):
+        for gid in gids:
+            try:
+                gathering = self.gatherings_db.find_one({"id": gid})
+            except Exception:
+                logger.exception("Failed to resync gathering %d, dropping it from the index", gid)
+                gathering = None
+
+            if gathering:
+                self.gathering_index.update(gathering)
+            else:
+                self.gathering_index.remove(gid)
+
+    def find_planned_gathering(self, request: MatchmakeRequest) -> int | None:
+        candidates = self.gathering_index.find_for_search_criteria(request.client.pid(), request.search_criteria, request.gathering, 40)
+        for gid in candidates:
+            entry = self.gathering_index.entries[gid]
+
+            # Friend-only gatherings need a friend list check, leave them to the regular path
+            if entry["participation_policy"] == 98:
+                continue
+
+            if GatheringIndex.free_slots(entry) >= request.num_players:
+                return gid
+
+        return None
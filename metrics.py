@@ -0,0 +1,250 @@
+from nintendo.nex import common
+from pymongo import monitoring
+import threading
+import asyncio
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cached lookup to a slow aggregation
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if len(names) == 0:
+        return ""
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    return "{%s}" % ",".join(pairs)
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self, kind: str = "counter") -> list[str]:
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, kind)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, format_labels(self.label_names, labels), value))
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def set(self, labels: tuple, value: float):
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self) -> list[str]:
+        return super().render("gauge")
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values: dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = [0] * (len(self.buckets) + 2)
+                self.values[labels] = entry
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s histogram" % self.name]
+        names = self.label_names + ("le",)
+        with self.lock:
+            for labels, entry in sorted(self.values.items()):
+                for i, bound in enumerate(self.buckets):
+                    lines.append("%s_bucket%s %d" % (self.name, format_labels(names, labels + (bound,)), entry[i]))
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(names, labels + ("+Inf",)), entry[-1]))
+                lines.append("%s_sum%s %s" % (self.name, format_labels(self.label_names, labels), entry[-2]))
+                lines.append("%s_count%s %d" % (self.name, format_labels(self.label_names, labels), entry[-1]))
+        return lines
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self, metrics: "Metrics"):
+        self.metrics = metrics
+        self.pending: dict[int, tuple[str, str]] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        self.pending[event.request_id] = (event.command_name, collection)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self.finish(event, "success")
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.finish(event, "failure")
+
+    def finish(self, event, status: str):
+        command, collection = self.pending.pop(event.request_id, (event.command_name, ""))
+        self.metrics.mongo_commands.inc((command, collection, status))
+        self.metrics.mongo_duration.observe((command, collection), event.duration_micros / 1000000)
+
+
+class Metrics:
+    """Process-wide metrics, exported in the Prometheus text format"""
+
+    def __init__(self):
+        self.rmc_duration = Histogram("nex_rmc_request_duration_seconds", "Time spent handling RMC requests",
+                                      ("protocol", "method_id", "method"))
+        self.rmc_in_flight = Gauge("nex_rmc_requests_in_flight", "RMC requests currently being handled",
+                                   ("protocol", "method_id", "method"))
+        self.rmc_errors = Counter("nex_rmc_errors_total", "RMC requests that returned an error",
+                                  ("protocol", "method_id", "method", "error"))
+        self.mongo_commands = Counter("nex_mongo_commands_total", "MongoDB commands sent",
+                                      ("command", "collection", "status"))
+        self.mongo_duration = Histogram("nex_mongo_command_duration_seconds", "MongoDB command latency",
+                                        ("command", "collection"))
+        self.redis_commands = Counter("nex_redis_commands_total", "Redis commands sent", ("command", "status"))
+        self.redis_duration = Histogram("nex_redis_command_duration_seconds", "Redis command latency", ("command",))
+
+        self.collectors = [self.rmc_duration, self.rmc_in_flight, self.rmc_errors,
+                           self.mongo_commands, self.mongo_duration, self.redis_commands, self.redis_duration]
+
+    # ============= Instrumentation =============
+
+    def instrument_server(self, server):
+        """Wraps every entry of the methods table of a NEX protocol server"""
+        for method_id, handler in list(server.methods.items()):
+            server.methods[method_id] = self.wrap_method(server.PROTOCOL_ID, method_id, handler)
+
+    def wrap_method(self, protocol_id: int, method_id: int, handler):
+        name = handler.__name__
+        if name.startswith("handle_"):
+            name = name[len("handle_"):]
+        labels = (protocol_id, method_id, name)
+
+        async def wrapper(client, input, output):
+            self.rmc_in_flight.inc(labels)
+            start = time.perf_counter()
+            try:
+                await handler(client, input, output)
+            except common.RMCError as e:
+                self.rmc_errors.inc(labels + (e.name(),))
+                raise
+            except Exception as e:
+                self.rmc_errors.inc(labels + ("PythonCore::%s" % e.__class__.__name__,))
+                raise
+            finally:
+                self.rmc_duration.observe(labels, time.perf_counter() - start)
+                self.rmc_in_flight.dec(labels)
+
+        wrapper.__name__ = handler.__name__
+        return wrapper
+
+    def register_mongo_listener(self):
+        # Must be called before the MongoClient is created
+        monitoring.register(MongoCommandListener(self))
+
+    def instrument_redis(self, redis_client):
+        # Scripts go through execute_command (EVALSHA), pipelines are counted once per execute()
+        execute_command = redis_client.execute_command
+
+        def wrapper(*args, **options):
+            command = str(args[0]).upper() if len(args) > 0 else ""
+            start = time.perf_counter()
+            try:
+                res = execute_command(*args, **options)
+            except Exception:
+                self.redis_commands.inc((command, "failure"))
+                raise
+            finally:
+                self.redis_duration.observe((command,), time.perf_counter() - start)
+
+            self.redis_commands.inc((command, "success"))
+            return res
+
+        redis_client.execute_command = wrapper
+
+        pipeline = redis_client.pipeline
+
+        def pipeline_wrapper(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            pipe_execute = pipe.execute
+
+            def execute(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    res = pipe_execute(*args, **kwargs)
+                except Exception:
+                    self.redis_commands.inc(("PIPELINE", "failure"))
+                    raise
+                finally:
+                    self.redis_duration.observe(("PIPELINE",), time.perf_counter() - start)
+
+                self.redis_commands.inc(("PIPELINE", "success"))
+                return res
+
+            pipe.execute = execute
+            return pipe
+
+        redis_client.pipeline = pipeline_wrapper
+
+    # ============= Exporting =============
+
+    def render(self) -> str:
+        lines = []
+        for collector in self.collectors:
+            lines += collector.render()
+        return "\n".join(lines) + "\n"
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] in ("/metrics", "/"):
+                body = self.render().encode("utf-8")
+                status = "200 OK"
+            else:
+                body = b"Not found\n"
+                status = "404 Not Found"
+
+            writer.write(("HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                          "Content-Length: %d\r\nConnection: close\r\n\r\n" % (status, len(body))).encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self.handle_http, host, port)
+        logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+        return server
+
+
+metrics = Metrics()
@@ -0,0 +1,75 @@
+from nintendo.nex import common
+from typing import Awaitable, Callable
+import contextvars
+import contextlib
+
+from nex_protocols_common_py.authentication_protocol import AuthenticationUser, CommonAuthenticationServer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class MK8AuthenticationServer(CommonAuthenticationServer):
+    """
+    The common server looks up NEX passwords synchronously (get_nex_password_func).
+    We fetch them asynchronously first, and hand the fetched password to the synchronous lookup of the same call,
+    so a cache entry expiring in between can't fail the login.
+    """
+
+    def __init__(self,
+                 settings,
+                 secure_host: str,
+                 secure_port: int,
+                 build_string: str,
+                 special_users: list[AuthenticationUser],
+                 get_nex_password_func: Callable[[int], str],
+                 fetch_nex_password_func: Callable[[int], Awaitable[str]],
+                 auth_callback: Callable[[AuthenticationUser], common.Result] = None):
+
+        super().__init__(settings, secure_host, secure_port, build_string, special_users, get_nex_password_func, auth_callback)
+        self.fetch_nex_password_func = fetch_nex_password_func
+        self.fetched_password = contextvars.ContextVar("fetched_password", default=None)
+
+    @contextlib.asynccontextmanager
+    async def fetched_nex_password(self, pid: int):
+        token = None
+        try:
+            password = await self.fetch_nex_password_func(pid)
+        except Exception as e:
+            # The login then fails with the same error as when the account doesn't exist
+            logger.warning("Couldn't fetch the NEX password of %d: %s", pid, e)
+        else:
+            token = self.fetched_password.set((pid, password))
+
+        # Calls of a connection share a task, so the password is only visible until this call returns
+        try:
+            yield
+        finally:
+            if token is not None:
+                self.fetched_password.reset(token)
+
+    def get_user_from_pid(self, pid: int):
+        fetched = self.fetched_password.get()
+        if fetched is not None and fetched[0] == pid:
+            return AuthenticationUser(pid, str(pid), fetched[1])
+        return super().get_user_from_pid(pid)
+
+    # ============= Method implementations  =============
+
+    async def login(self, client, username):
+        if not username.isdigit():
+            return await super().login(client, username)
+
+        async with self.fetched_nex_password(int(username)):
+            return await super().login(client, username)
+
+    async def login_ex(self, client, username, extra_data):
+        if not username.isdigit():
+            return await super().login_ex(client, username, extra_data)
+
+        async with self.fetched_nex_password(int(username)):
+            return await super().login_ex(client, username, extra_data)
+
+    async def request_ticket(self, client, source, target):
+        async with self.fetched_nex_password(source):
+            return await super().request_ticket(client, source, target)
@@ -1,11 +1,19 @@
 from nintendo.nex import datastore, rmc, common
 from pymongo.collection import Collection
+from collections import OrderedDict
 from typing import Callable
 import datetime
 import pymongo
+import bson
+import time
 from minio import Minio
 
 from nex_protocols_common_py.datastore_protocol import CommonDataStoreServer
+from object_storage import ObjectStorage, S3ObjectStorage
+from ttl_cache import TTLCache
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 class MK8DataStoreChangeMetaParam(common.Structure):
@@ -123,6 +131,81 @@ class MK8DataStoreSearchParam(common.Structure):
         stream.u32(self.minimal_rating_frequency)
 
 
+# persistence_id is set when the first upload of an object completes, and kept while the object is being updated
+VALIDATED_OBJECT_FILTER = {"persistence_id": {"$exists": True}}
+
+# What get_object_infos needs to build a download URL
+OBJECT_INFO_PROJECTION = {"_id": 0, "id": 1, "owner": 1, "persistence_id": 1, "size": 1, "storage_key": 1}
+
+# MKTV highlights get a key per object, ghosts are overwritten in their owner's slot (see mk8_calculate_s3_object_key)
+MKTV_FIRST_PERSISTENCE_ID = 1024
+
+# What search_object returns, meta_binary is only added when asked for
+SEARCH_PROJECTION = {
+    "_id": 0, "id": 1, "owner": 1, "name": 1, "size": 1, "data_type": 1, "flag": 1, "period": 1, "tags": 1,
+    "access_permission": 1, "delete_permission": 1, "create_time": 1, "update_time": 1, "referred_time": 1, "ratings": 1
+}
+
+# Field sorted by each result_order_column, the data ID is the tie-breaker so the order is stable across pages
+SEARCH_SORT_FIELDS = {
+    5: "create_time",
+    64: "ratings.0.value",
+}
+
+# modifies_flag/comparison_flag bit -> document field
+CHANGE_META_FIELDS = [
+    (0x01, "name"),
+    (0x02, "access_permission"),
+    (0x04, "delete_permission"),
+    (0x08, "period"),
+    (0x10, "meta_binary"),
+    (0x20, "tags"),
+    (0x40, "referred_count"),
+    (0x80, "data_type"),
+    (0x100, "status"),
+]
+
+# Fields change_meta writes (period, meta_binary, data_type), the others can only be compared
+CHANGE_META_WRITABLE_FLAGS = 0x08 | 0x10 | 0x80
+
+
+class PresignedUrlCache:
+    """
+    Presigned GET URLs by S3 object key. A URL is handed out again for reuse_time seconds after it was signed,
+    which is shorter than its lifetime, so clients always get a URL that stays valid for lifetime - reuse_time.
+    """
+
+    def __init__(self, storage: ObjectStorage, lifetime: float, reuse_time: float, max_size: int):
+        if reuse_time >= lifetime:
+            raise ValueError("The reuse time of presigned URLs must be shorter than their lifetime")
+
+        self.storage = storage
+        self.lifetime = datetime.timedelta(seconds=lifetime)
+        self.reuse_time = reuse_time
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_url(self, key: str) -> str:
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] >= time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        url = self.storage.presigned_get_url(key, self.lifetime)
+        if self.reuse_time > 0:
+            self.entries[key] = (time.monotonic() + self.reuse_time, url)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        return url
+
+
 class MK8DataStoreServer(CommonDataStoreServer):
     def __init__(self,
                  settings,
@@ -131,7 +214,12 @@ class MK8DataStoreServer(CommonDataStoreServer):
                  datastore_db: Collection,
                  sequence_db: Collection,
                  calculate_s3_object_key: Callable[[Collection, rmc.RMCClient, int, int], str],
-                 calculate_s3_object_key_ex: Callable[[Collection, int, int, int], str]):
+                 calculate_s3_object_key_ex: Callable[[Collection, int, int, int], str],
+                 url_lifetime: float = 15 * 60,
+                 url_reuse_time: float = 10 * 60,
+                 url_cache_size: int = 100000,
+                 storage: ObjectStorage | None = None,
+                 info_cache_size: int = 50000):
 
         super().__init__(settings,
                          s3_client,
@@ -141,16 +229,609 @@ class MK8DataStoreServer(CommonDataStoreServer):
                          calculate_s3_object_key,
                          calculate_s3_object_key_ex)
 
+        self.storage = storage or S3ObjectStorage(s3_client, s3_bucket, max_workers=8)
+        self.url_cache = PresignedUrlCache(self.storage, url_lifetime, url_reuse_time, url_cache_size)
+        self.info_cache = TTLCache(None, info_cache_size)  # Data ID -> OBJECT_INFO_PROJECTION fields of validated objects
+
+        self.search_cursors = TTLCache(None, 10000)  # (PID, query, offset) -> sort values of the last object before offset
+
+        self.datastore_db.create_index("id")
+        self.datastore_db.create_index([("data_type", pymongo.ASCENDING), ("create_time", pymongo.DESCENDING), ("id", pymongo.DESCENDING)])
+        self.datastore_db.create_index([("data_type", pymongo.ASCENDING), ("ratings.0.value", pymongo.DESCENDING), ("id", pymongo.DESCENDING)])
+        self.datastore_db.create_index([("owner", pymongo.ASCENDING), ("data_type", pymongo.ASCENDING)])
+        self.datastore_db.create_index("tags")
+        self.datastore_db.create_index([("content_hash", pymongo.ASCENDING), ("size", pymongo.ASCENDING)])
+        self.datastore_db.create_index("storage_key", sparse=True)
+
         self.methods[43] = self.handle_get_object_infos
 
     # ==================================================================================
 
+    def make_object_document(self, client, param: datastore.DataStorePreparePostParam) -> dict:
+        doc = {
+            "id": self.get_next_datastore_object_id(),
+            "owner": client.pid(),
+            "data_type": param.data_type,
+            "extra_data": param.extra_data,
+            "flag": param.flag,
+            "meta_binary": param.meta_binary,
+            "name": param.name,
+            "period": param.period,
+            "refer_data_id": param.refer_data_id,
+            "size": param.size,
+            "tags": param.tags,
+            "delete_permission": {
+                "permission": param.delete_permission.permission,
+                "recipients": param.delete_permission.recipients,
+            },
+            "access_permission": {
+                "permission": param.permission.permission,
+                "recipients": param.permission.recipients,
+            },
+            "tmp_persistence_id": param.persistence_init_param.persistence_id,
+            "is_validated": False,
+            "create_time": datetime.datetime.utcnow(),
+            "update_time": datetime.datetime.utcnow(),
+            "referred_time": datetime.datetime.utcnow(),
+            "expire_time": datetime.datetime(9999, 12, 31),
+        }
+
+        ratings = []
+        for rating in param.rating_init_param:
+            ratings.append({
+                "slot": rating.slot,
+                "initial_value": rating.param.initial_value,
+                "value": rating.param.initial_value,
+                "min_val": rating.param.range_min,
+                "max_val": rating.param.range_max,
+                "lock_type": rating.param.lock_type,
+                "period_duration": rating.param.period_duration,
+                "period_hour": rating.param.period_hour,
+                "count": 0,
+            })
+
+        doc.update({"ratings": ratings})
+        return doc
+
+    @staticmethod
+    def make_form(form: dict[str, str]) -> list[datastore.DataStoreKeyValue]:
+        fields = []
+        for key, value in form.items():
+            field = datastore.DataStoreKeyValue()
+            field.key = key
+            field.value = value
+            fields.append(field)
+
+        return fields
+
+    async def prepare_post_object(self, client, param: datastore.DataStorePreparePostParam) -> datastore.DataStoreReqPostInfo:
+
+        self.validate_prepare_post_param(client, param)
+
+        doc = self.make_object_document(client, param)
+        self.datastore_db.insert_one(doc)
+
+        key = self.calculate_s3_object_key(self.datastore_db, client, param.persistence_init_param.persistence_id, doc["id"])
+        url, form = self.storage.presigned_post(key, param.size, datetime.timedelta(minutes=15))
+
+        res = datastore.DataStoreReqPostInfo()
+        res.url = url
+        res.form = self.make_form(form)
+        res.headers = []
+        res.data_id = doc["id"]
+        res.root_ca_cert = b""
+
+        return res
+
+    def get_object_key(self, obj: dict) -> str:
+        if "storage_key" in obj:
+            return obj["storage_key"]
+
+        return self.calculate_s3_object_key_ex(self.datastore_db, obj["owner"], obj["persistence_id"], obj["id"])
+
+    async def stat_uploaded_object(self, key: str) -> tuple[int, str]:
+        try:
+            size, content_hash = await self.storage.stat_object(key)
+        except Exception:
+            logger.exception("Failed to stat %s", key)
+            raise common.RMCError("DataStore::NotFound")
+
+        if size == 0:
+            raise common.RMCError("DataStore::NotFound")
+
+        return size, content_hash
+
+    @staticmethod
+    def make_update_key(key: str) -> str:
+        return "%s.%s" % (key, bson.ObjectId())
+
+    @staticmethod
+    def is_update_key(key: str, own_key: str) -> bool:
+        return key.startswith(own_key + ".")
+
+    async def find_shared_storage_key(self, data_id: int, key: str, size: int, content_hash: str) -> str | None:
+        """
+        Key of an identical MKTV object uploaded before, in which case the new upload is deleted
+        and the object points to the existing one. Only objects with their own key are shared.
+        """
+        original = self.datastore_db.find_one({
+            "content_hash": content_hash,
+            "size": size,
+            "is_validated": True,
+            "persistence_id": {"$gte": MKTV_FIRST_PERSISTENCE_ID},
+            "storage_key": {"$exists": False},
+            "id": {"$ne": data_id}
+        }, {"_id": 0, "id": 1, "owner": 1, "persistence_id": 1})
+        if not original:
+            return None
+
+        original_key = self.get_object_key(original)
+        try:
+            await self.storage.remove_object(key)
+        except Exception:
+            logger.exception("Failed to remove %s, a duplicate of %s", key, original_key)
+            return None
+
+        return original_key
+
+    async def complete_post_object(self, client, param: datastore.DataStoreCompletePostParam):
+        if not param.success:
+            return
+
+        datastore_object = self.datastore_db.find_one({"id": param.data_id})
+        if not datastore_object or (client.pid() != datastore_object["owner"]):
+            raise common.RMCError("DataStore::PermissionDenied")
+
+        persistence_id = datastore_object["tmp_persistence_id"]
+        key = self.calculate_s3_object_key(self.datastore_db, client, persistence_id, param.data_id)
+        size, content_hash = await self.stat_uploaded_object(key)
+
+        update = {"is_validated": True, "persistence_id": persistence_id, "content_hash": content_hash}
+        if persistence_id >= MKTV_FIRST_PERSISTENCE_ID:
+            shared_key = await self.find_shared_storage_key(param.data_id, key, size, content_hash)
+            if shared_key:
+                update["storage_key"] = shared_key
+
+        # Replaces the previous object in this slot
+        replaced_query = {"owner": client.pid(), "persistence_id": persistence_id, "id": {"$ne": param.data_id}}
+        for replaced in self.datastore_db.find(replaced_query, {"_id": 0, "id": 1}):
+            self.info_cache.delete(replaced["id"])
+        self.datastore_db.delete_many(replaced_query)
+        self.datastore_db.update_one({"id": param.data_id}, {"$set": update})
+
+    async def prepare_update_object(self, client, param: datastore.DataStorePrepareUpdateParam) -> datastore.DataStoreReqUpdateInfo:
+
+        obj = self.datastore_db.find_one({"id": param.data_id})
+        if not obj:
+            raise common.RMCError("DataStore::NotFound")
+
+        if client.pid() != obj["owner"]:
+            raise common.RMCError("DataStore::PermissionDenied")
+
+        # Identical uploads may point to the object's own key, they keep that blob and the update gets a new key
+        key = self.calculate_s3_object_key(self.datastore_db, client, obj["persistence_id"], param.data_id)
+        if self.datastore_db.find_one({"storage_key": key, "id": {"$ne": param.data_id}}, {"_id": 1}):
+            key = self.make_update_key(key)
+
+        url, form = self.storage.presigned_post(key, param.size, datetime.timedelta(minutes=15))
+
+        res = datastore.DataStoreReqUpdateInfo()
+        res.url = url
+        res.form = self.make_form(form)
+        res.headers = []
+        res.root_ca_cert = b""
+        res.version = 2
+
+        self.datastore_db.update_one({"id": param.data_id}, {"$set": {"is_validated": False, "update_size": param.size, "update_key": key}})
+        self.info_cache.delete(param.data_id)
+
+        return res
+
+    async def complete_update_object(self, client, param: datastore.DataStoreCompleteUpdateParam):
+        if not param.success:
+            return
+
+        datastore_object = self.datastore_db.find_one({"id": param.data_id})
+        if not datastore_object or (client.pid() != datastore_object["owner"]):
+            raise common.RMCError("DataStore::PermissionDenied")
+
+        own_key = self.calculate_s3_object_key(self.datastore_db, client, datastore_object["persistence_id"], param.data_id)
+        key = datastore_object.get("update_key", own_key)
+        size, content_hash = await self.stat_uploaded_object(key)
+
+        update = {
+            "$set": {"is_validated": True, "size": datastore_object["update_size"], "content_hash": content_hash},
+            "$unset": {"update_key": ""}
+        }
+        if key == own_key:
+            update["$unset"]["storage_key"] = ""
+        else:
+            update["$set"]["storage_key"] = key
+
+        self.datastore_db.update_one({"id": param.data_id}, update)
+        self.info_cache.delete(param.data_id)
+
+        # The key given by a previous update was only used by this object
+        previous_key = datastore_object.get("storage_key")
+        if previous_key and previous_key != key and self.is_update_key(previous_key, own_key):
+            try:
+                await self.storage.remove_object(previous_key)
+            except Exception:
+                logger.exception("Failed to remove %s, replaced by %s", previous_key, key)
+
+    async def prepare_get_object(self, client, param: datastore.DataStorePrepareGetParam) -> datastore.DataStoreReqGetInfo:
+        query = {}
+        if param.persistence_target.owner_id:
+            query.update({"owner": param.persistence_target.owner_id})
+
+        if param.data_id:
+            query.update({"id": param.data_id})
+
+        if param.persistence_target.persistence_id:
+            query.update({"persistence_id": param.persistence_target.persistence_id})
+
+        # Fix for the old bad implementation that didn't enforce a single object per owner/persistence_id
+        obj = self.datastore_db.find_one(query, sort=[('create_time', -1)])
+        if not obj:
+            raise common.RMCError("DataStore::NotFound")
+
+        if "storage_key" in obj:
+            key = obj["storage_key"]
+        else:
+            key = self.calculate_s3_object_key_ex(
+                self.datastore_db,
+                param.persistence_target.owner_id,
+                param.persistence_target.persistence_id,
+                obj["id"])
+
+        res = datastore.DataStoreReqGetInfo()
+        res.url = self.url_cache.get_url(key)
+        res.size = obj["size"]
+        res.data_id = obj["id"]
+        res.headers = []
+        res.root_ca_cert = b""
+
+        return res
+
+    async def get_object_infos(self, client, object_ids: list[int]):
+        objects = {}
+        missing_ids = []
+        for object_id in set(object_ids):
+            obj = self.info_cache.get(object_id)
+            if obj is None:
+                missing_ids.append(object_id)
+            else:
+                objects[object_id] = obj
+
+        if len(missing_ids) > 0:
+            for obj in self.datastore_db.find({"id": {"$in": missing_ids}, **VALIDATED_OBJECT_FILTER}, OBJECT_INFO_PROJECTION):
+                objects[obj["id"]] = obj
+                self.info_cache.set(obj["id"], obj)
+
+        res = rmc.RMCResponse()
+        res.infos = []
+        res.results = []
+
+        for object_id in object_ids:
+
+            info = datastore.DataStoreReqGetInfo()
+            info.url = ""
+            info.headers = []
+            info.data_id = object_id
+            info.size = 0
+            info.root_ca_cert = b""
+
+            obj = objects.get(object_id)
+            if not obj:
+                res.infos.append(info)
+                res.results.append(common.Result.error("DataStore::NotFound"))
+                continue
+
+            info.url = self.url_cache.get_url(self.get_object_key(obj))
+            info.size = obj["size"]
+            res.infos.append(info)
+            res.results.append(common.Result.success("DataStore::Unknown"))
+
+        return res
+
+    @staticmethod
+    def is_datetime_set(value: common.DateTime) -> bool:
+        return value.value() != 0 and value.value() != common.DateTime.future().value()
+
+    def make_search_query(self, param: MK8DataStoreSearchParam) -> dict:
+        query = dict(VALIDATED_OBJECT_FILTER)
+        if param.data_type != 65535:
+            query["data_type"] = param.data_type
+
+        if len(param.owner_ids) > 0:
+            query["owner"] = {"$in": param.owner_ids}
+
+        if param.refer_data_id:
+            query["refer_data_id"] = param.refer_data_id
+
+        if len(param.tags) > 0:
+            query["tags"] = {"$all": param.tags}
+
+        for field, after, before in [("create_time", param.created_after, param.created_before),
+                                     ("update_time", param.updated_after, param.updated_before)]:
+            time_range = {}
+            if self.is_datetime_set(after):
+                time_range["$gte"] = after.standard_datetime()
+            if self.is_datetime_set(before):
+                time_range["$lte"] = before.standard_datetime()
+            if time_range:
+                query[field] = time_range
+
+        return query
+
+    @staticmethod
+    def get_search_sort(param: MK8DataStoreSearchParam) -> list[tuple[str, int]]:
+        direction = pymongo.DESCENDING if param.result_order == 1 else pymongo.ASCENDING
+        field = SEARCH_SORT_FIELDS.get(param.result_order_column)
+        if field is None:
+            return [("id", direction)]
+        return [(field, direction), ("id", direction)]
+
+    @staticmethod
+    def get_sort_values(obj: dict, sort: list[tuple[str, int]]) -> list:
+        # None for missing fields (e.g. an object without ratings), which MongoDB sorts like null
+        values = []
+        for field, _ in sort:
+            value = obj
+            for part in field.split("."):
+                if isinstance(value, list):
+                    value = value[int(part)] if int(part) < len(value) else None
+                elif isinstance(value, dict):
+                    value = value.get(part)
+                else:
+                    value = None
+            values.append(value)
+
+        return values
+
+    @staticmethod
+    def match_sort_value(field: str, value) -> dict:
+        if value is None:
+            return {"$or": [{field: None}, {field: {"$exists": False}}]}
+        return {field: value}
+
+    @classmethod
+    def make_keyset_filter(cls, sort: list[tuple[str, int]], values: list) -> dict:
+        # Objects strictly after the given sort values, in the sort order.
+        # Null and missing values sort before any other value.
+        clauses = []
+        for i, (field, direction) in enumerate(sort):
+            ties = [cls.match_sort_value(sort[j][0], values[j]) for j in range(i)]
+            if values[i] is None:
+                after = [{field: {"$exists": True, "$ne": None}}] if direction == pymongo.ASCENDING else []
+            elif direction == pymongo.ASCENDING:
+                after = [{field: {"$gt": values[i]}}]
+            else:
+                after = [{field: {"$lt": values[i]}}, cls.match_sort_value(field, None)]
+
+            for condition in after:
+                clauses.append({"$and": ties + [condition]} if ties else condition)
+
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+    @staticmethod
+    def make_meta_info(obj: dict, result_option: int) -> datastore.DataStoreMetaInfo:
+        meta = datastore.DataStoreMetaInfo()
+        meta.meta_binary = b''
+        meta.status = 0
+        meta.referred_count = 0
+        meta.refer_data_id = 0
+        meta.ratings = []
+
+        meta.data_id = obj["id"]
+        meta.owner_id = obj["owner"]
+        meta.name = obj["name"]
+        meta.size = obj["size"]
+        meta.data_type = obj["data_type"]
+        meta.flag = obj["flag"]
+        meta.period = obj["period"]
+        meta.tags = obj["tags"]
+
+        if result_option & 4:
+            meta.meta_binary = obj["meta_binary"]
+
+        meta.permission.permission = obj["access_permission"]["permission"]
+        meta.permission.recipients = obj["access_permission"]["recipients"]
+        meta.delete_permission.recipients = obj["delete_permission"]["recipients"]
+        meta.delete_permission.recipients = obj["delete_permission"]["recipients"]
+
+        meta.create_time = common.DateTime.fromtimestamp(datetime.datetime.timestamp(obj["create_time"]))
+        meta.update_time = common.DateTime.fromtimestamp(datetime.datetime.timestamp(obj["update_time"]))
+        meta.referred_time = common.DateTime.fromtimestamp(datetime.datetime.timestamp(obj["referred_time"]))
+        meta.expire_time = common.DateTime.fromtimestamp(datetime.datetime.timestamp(obj["create_time"]))
+
+        for rating in obj["ratings"]:
+            rate = datastore.DataStoreRatingInfoWithSlot()
+            rate.slot = rating["slot"]
+            rate.info.initial_value = rating["initial_value"]
+            rate.info.total_value = rating["value"]
+            rate.info.count = rating["count"]
+            meta.ratings.append(rate)
+
+        return meta
+
+    async def search_object(self, client, param: MK8DataStoreSearchParam) -> datastore.DataStoreSearchResult:
+
+        if param.result_range.size > 100:
+            raise common.RMCError("DataStore::InvalidArgument")
+
+        query = self.make_search_query(param)
+        sort = self.get_search_sort(param)
+
+        projection = dict(SEARCH_PROJECTION)
+        if param.result_option & 4:
+            projection["meta_binary"] = 1
+
+        # Clients page through results with offsets. When a page follows the previous one of the same client,
+        # continue from where it ended instead of skipping over all the objects before it.
+        cursor_key = (client.pid(), repr(query), repr(sort), param.result_range.offset)
+        last_values = self.search_cursors.get(cursor_key) if param.result_range.offset > 0 else None
+        if last_values is not None:
+            cursor = self.datastore_db.find({"$and": [query, self.make_keyset_filter(sort, last_values)]}, projection)
+        else:
+            cursor = self.datastore_db.find(query, projection).skip(param.result_range.offset)
+
+        objects = list(cursor.sort(sort).limit(param.result_range.size))
+
+        if len(objects) == param.result_range.size and len(objects) > 0:
+            next_key = (client.pid(), repr(query), repr(sort), param.result_range.offset + len(objects))
+            self.search_cursors.set(next_key, self.get_sort_values(objects[-1], sort))
+
+        search_result = datastore.DataStoreSearchResult()
+        search_result.total_count = len(objects)
+        search_result.total_count_type = len(objects)
+        search_result.result = [self.make_meta_info(obj, param.result_option) for obj in objects]
+
+        return search_result
+
+    @staticmethod
+    def get_meta_fields(param: MK8DataStoreChangeMetaParam | datastore.DataStoreChangeMetaCompareParam, flags: int) -> dict:
+        # The change and compare params have the same fields
+        values = {
+            "name": lambda: param.name,
+            "access_permission": lambda: {"permission": param.permission.permission, "recipients": param.permission.recipients},
+            "delete_permission": lambda: {"permission": param.delete_permission.permission, "recipients": param.delete_permission.recipients},
+            "period": lambda: param.period,
+            "meta_binary": lambda: param.meta_binary,
+            "tags": lambda: param.tags,
+            "referred_count": lambda: param.referred_count,
+            "data_type": lambda: param.data_type,
+            "status": lambda: param.status,
+        }
+
+        return {field: values[field]() for flag, field in CHANGE_META_FIELDS if flags & flag}
+
+    def check_change_meta(self, client, obj: dict | None, expected: dict):
+        if not obj:
+            raise common.RMCError("DataStore::NotFound")
+
+        if client.pid() != obj["owner"]:
+            raise common.RMCError("DataStore::PermissionDenied")
+
+        for field, value in expected.items():
+            if obj.get(field) != value:
+                raise common.RMCError("DataStore::ValueNotEqual")
+
+    async def change_meta(self, client, param: MK8DataStoreChangeMetaParam):
+        changes = self.get_meta_fields(param, param.modifies_flag & CHANGE_META_WRITABLE_FLAGS)
+        expected = self.get_meta_fields(param.compare_param, param.compare_param.comparison_flag)
+
+        # Owner and compared values are checked in the same update, which only matches when a value actually changes
+        if changes:
+            query = {"id": param.data_id, "owner": client.pid(), **expected}
+            query["$or"] = [{field: {"$ne": value}} for field, value in changes.items()]
+            if self.datastore_db.update_one(query, {"$set": changes}).matched_count == 1:
+                return
+
+        # Nothing was written, either nothing changed or there is an error to report
+        projection = {"_id": 0, "owner": 1}
+        projection.update({field: 1 for field in expected})
+        self.check_change_meta(client, self.datastore_db.find_one({"id": param.data_id}, projection), expected)
+
+    async def change_metas(self, client, data_ids: list[int], params: list[MK8DataStoreChangeMetaParam], transactional: bool) -> list[common.Result]:
+        if len(data_ids) != len(params) or len(params) > 100:
+            raise common.RMCError("DataStore::InvalidArgument")
+
+        # One read for all the objects, then only the updates that change something, in one write
+        objects = {obj["id"]: obj for obj in self.datastore_db.find({"id": {"$in": data_ids}}, {"_id": 0})}
+
+        results: list[common.Result | None] = []
+        written: list[tuple[int, int]] = []  # Index in results, data ID of the write deciding the result
+        updates: dict[int, dict] = {}  # Data ID -> compared values, changes and previous values of its write
+        for data_id, param in zip(data_ids, params):
+            expected = self.get_meta_fields(param.compare_param, param.compare_param.comparison_flag)
+            try:
+                self.check_change_meta(client, objects.get(data_id), expected)
+            except common.RMCError as e:
+                if transactional:
+                    raise
+                results.append(e.result())
+                continue
+
+            obj = objects[data_id]
+            changes = {field: value for field, value in self.get_meta_fields(param, param.modifies_flag & CHANGE_META_WRITABLE_FLAGS).items() if obj.get(field) != value}
+            if not changes:
+                results.append(common.Result.success("DataStore::Unknown"))
+                continue
+
+            # Changes of the same object are merged into its first write, each was checked against the object as changed before it
+            update = updates.setdefault(data_id, {"expected": expected, "changes": {}, "previous": {}})
+            for field in changes:
+                update["previous"].setdefault(field, obj.get(field))
+            update["changes"].update(changes)
+            obj.update(changes)
+
+            written.append((len(results), data_id))
+            results.append(None)
+
+        errors = self.write_change_metas(client, updates, transactional)
+        for index, data_id in written:
+            results[index] = errors[data_id].result() if data_id in errors else common.Result.success("DataStore::Unknown")
+
+        return results
+
+    def write_change_metas(self, client, updates: dict[int, dict], transactional: bool) -> dict[int, common.RMCError]:
+        """Returns the error of every object whose write didn't go through"""
+        if len(updates) == 0:
+            return {}
+
+        requests = [pymongo.UpdateOne({"id": data_id, "owner": client.pid(), **update["expected"]}, {"$set": update["changes"]})
+                    for data_id, update in updates.items()]
+        if self.datastore_db.bulk_write(requests, ordered=True).matched_count == len(requests):
+            return {}
+
+        # Some objects changed since they were read, tell the writes that went through from the others
+        errors = {}
+        current = {obj["id"]: obj for obj in self.datastore_db.find({"id": {"$in": list(updates)}}, {"_id": 0})}
+        for data_id, update in updates.items():
+            obj = current.get(data_id)
+            if obj and all(obj.get(field) == value for field, value in update["changes"].items()):
+                continue
+
+            try:
+                self.check_change_meta(client, obj, update["expected"])
+            except common.RMCError as e:
+                errors[data_id] = e
+                continue
+
+            # The compared values match again, the object was changed back in the meantime
+            if self.datastore_db.update_one({"id": data_id, "owner": client.pid(), **update["expected"]}, {"$set": update["changes"]}).matched_count == 0:
+                errors[data_id] = common.RMCError("DataStore::ValueNotEqual")
+
+        if transactional and errors:
+            # Without a multi-document transaction, the writes that went through are reverted before failing the call
+            reverts = [pymongo.UpdateOne({"id": data_id, **update["changes"]}, {"$set": update["previous"]})
+                       for data_id, update in updates.items() if data_id not in errors]
+            if reverts:
+                self.datastore_db.bulk_write(reverts, ordered=False)
+            raise next(iter(errors.values()))
+
+        return errors
+
+    # ==================================================================================
+
     async def handle_change_meta(self, client, input, output):
         datastore.logger.info("DataStoreServer.change_meta()")
         # --- request ---
         param = input.extract(MK8DataStoreChangeMetaParam)
         await self.change_meta(client, param)
 
+    async def handle_change_metas(self, client, input, output):
+        datastore.logger.info("DataStoreServer.change_metas()")
+        # --- request ---
+        data_ids = input.list(input.u64)
+        params = input.list(MK8DataStoreChangeMetaParam)
+        transactional = input.bool()
+        response = await self.change_metas(client, data_ids, params, transactional)
+
+        # --- response ---
+        output.list(response, output.result)
+
     async def handle_search_object(self, client, input, output):
         datastore.logger.info("DataStoreServer.search_object()")
         # --- request ---
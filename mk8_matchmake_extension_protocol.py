@@ -1,12 +1,16 @@
-from nintendo.nex import rmc, common, matchmaking_mk8d
+from nintendo.nex import rmc, common, matchmaking, matchmaking_mk8d
 from pymongo.collection import Collection
-from typing import Callable
+from pymongo import ReturnDocument
+from typing import Awaitable, Callable
+import asyncio
 
 from nex_protocols_common_py.matchmake_extension_protocol import CommonMatchmakeExtensionServer
 
 from nex_protocols_common_py.secure_connection_protocol import CommonSecureConnectionServer
 import nex_protocols_common_py.matchmaking_utils as matchmaking_utils
 import simple_search_object_utils
+from gathering_index import GatheringIndex
+from matchmaking_scheduler import MatchmakingScheduler
 
 
 import logging
@@ -22,17 +26,33 @@ class MK8MatchmakeExtensionServer(CommonMatchmakeExtensionServer):
     METHOD_JOIN_MATCHMAKE_SESSION_WITH_EXTRA_PARTICIPANTS = 40
     METHOD_SEARCH_SIMPLE_SEARCH_OBJECT_BY_OBJECT_IDS = 41
 
+    JOIN_MAX_RETRIES = 3
+
     def __init__(self,
                  settings,
                  gatherings_db: Collection,
                  sequence_db: Collection,
-                 get_friend_pids_func: Callable[[int], list[int]],
+                 get_friend_pids_func: Callable[[int], Awaitable[list[int]]],
                  secure_connection_server: CommonSecureConnectionServer,
-                 tournaments_db: Collection):
+                 tournaments_db: Collection,
+                 matchmaking_batch_window: float = 0.0,
+                 prefetch_friend_pids_func: Callable[[list[int]], Awaitable[None]] = None):
 
         super().__init__(settings, gatherings_db, sequence_db, get_friend_pids_func, secure_connection_server)
         self.settings = settings
         self.tournaments_db = tournaments_db
+        self.prefetch_friend_pids = prefetch_friend_pids_func
+        self.prefetch_tasks: set[asyncio.Task] = set()
+
+        self.gatherings_db.create_index("id")
+        self.join_contention_count = 0
+        self.gathering_index = GatheringIndex()
+        self.gathering_index.load(self.gatherings_db)
+
+        # Auto-matchmaking requests are assigned in batches when a batching window is configured
+        self.matchmaking_scheduler = None
+        if matchmaking_batch_window > 0:
+            self.matchmaking_scheduler = MatchmakingScheduler(self.gatherings_db, self.sequence_db, self.gathering_index, matchmaking_batch_window)
 
         self.methods.update({
             self.METHOD_CREATE_SIMPLE_SEARCH_OBJECT: self.handle_create_simple_search_object,
@@ -70,6 +90,78 @@ class MK8MatchmakeExtensionServer(CommonMatchmakeExtensionServer):
     def verify_simple_search_object_type(self, obj: matchmaking_mk8d.SimpleSearchObject):
         simple_search_object_utils.verify_simple_search_object_type(obj)
 
+    async def can_user_join_gathering(self, client: rmc.RMCClient, gathering) -> bool:
+        if gathering["participation_policy"] == 98:  # Only WiiU friends can participate
+            friend_pids = await self.get_friend_pids(gathering["owner"])
+            return client.pid() in friend_pids
+        return True
+
+    def prefetch_gathering_friend_lists(self, gathering: dict):
+        # Ownership moves to another player when the owner leaves, have all their friend lists ready
+        if self.prefetch_friend_pids and gathering["participation_policy"] == 98:
+            # The loop only keeps a weak reference to tasks, hold on to them until they are done
+            task = asyncio.create_task(self.prefetch_friend_pids(gathering["players"]))
+            self.prefetch_tasks.add(task)
+            task.add_done_callback(self.prefetch_done)
+
+    def prefetch_done(self, task: asyncio.Task):
+        self.prefetch_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.warning("Friend list prefetch failed: %s", task.exception())
+
+    def try_add_user_to_gathering(self, client, gid: int, num_added: int, extra_filters: dict) -> dict | None:
+        pid_list = [client.pid()] + [-client.pid()] * (num_added - 1)
+
+        # The participant count guard is part of the filter, so concurrent joins can't overfill the gathering
+        query = {
+            "id": gid,
+            "players": {"$nin": [client.pid()]},
+            "$expr": {"$lte": [{"$add": [{"$size": "$players"}, num_added]}, "$max_participants"]}
+        }
+        query.update(extra_filters)
+
+        return self.gatherings_db.find_one_and_update(query, {
+            "$push": {"players": {"$each": pid_list}},
+            "$inc": {"num_participants": num_added}
+        }, return_document=ReturnDocument.AFTER)
+
+    async def join_gathering(self, client, gid: int, num_added: int) -> dict:
+        for i in range(self.JOIN_MAX_RETRIES):
+            gathering = self.try_add_user_to_gathering(client, gid, num_added, {"participation_policy": {"$ne": 98}})
+            if gathering:
+                self.gathering_index.update(gathering)
+                return gathering
+
+            # The update didn't match, read the gathering to know why
+            gathering = self.gatherings_db.find_one({"id": gid})
+            if not gathering:
+                self.gathering_index.remove(gid)
+                raise common.RMCError("RendezVous::SessionVoid")
+
+            self.gathering_index.update(gathering)
+
+            if client.pid() in gathering["players"]:
+                raise common.RMCError("RendezVous::AlreadyParticipatedGathering")
+
+            if (len(gathering["players"]) + num_added) > gathering["max_participants"]:
+                raise common.RMCError("RendezVous::SessionFull")
+
+            if gathering["participation_policy"] == 98:
+                if not await self.can_user_join_gathering(client, gathering):
+                    raise common.RMCError("RendezVous::NotFriend")
+
+                # The friend list was checked against this owner, make sure it didn't change
+                gathering = self.try_add_user_to_gathering(client, gid, num_added, {"owner": gathering["owner"]})
+                if gathering:
+                    self.gathering_index.update(gathering)
+                    self.prefetch_gathering_friend_lists(gathering)
+                    return gathering
+
+            # Another player joined or left between the update and the read, try again
+            self.join_contention_count += 1
+
+        raise common.RMCError("RendezVous::SessionFull")
+
     # ============= Method handlers implementations  =============
 
     async def handle_create_simple_search_object(self, client, input, output):
@@ -136,6 +228,63 @@ class MK8MatchmakeExtensionServer(CommonMatchmakeExtensionServer):
 
     # ============= Method implementations  =============
 
+    async def create_matchmake_session(self, client, gathering, description: str, num_participants: int):
+        response = await super().create_matchmake_session(client, gathering, description, num_participants)
+
+        created_gathering = self.gatherings_db.find_one({"id": response.gid})
+        if created_gathering:
+            self.gathering_index.update(created_gathering)
+            self.prefetch_gathering_friend_lists(created_gathering)
+
+        return response
+
+    async def create_matchmake_session_with_param(self, client, param: matchmaking.CreateMatchmakeSessionParam):
+        response = await super().create_matchmake_session_with_param(client, param)
+
+        created_gathering = self.gatherings_db.find_one({"id": response.id})
+        if created_gathering:
+            self.gathering_index.update(created_gathering)
+            self.prefetch_gathering_friend_lists(created_gathering)
+
+        return response
+
+    async def auto_matchmake_with_search_criteria_postpone(self, client, search_criteria: list[matchmaking.MatchmakeSessionSearchCriteria], gathering, message):
+
+        if len(message) > 128:
+            raise common.RMCError("Core::InvalidArgument")
+
+        self.verify_search_criterias(search_criteria)
+        self.verify_gathering_type(gathering)
+
+        num_players = 1
+        if len(search_criteria) > 0:
+            num_players = search_criteria[0].vacant_participants
+
+        if self.matchmaking_scheduler:
+            res_gathering = await self.matchmaking_scheduler.submit(client, search_criteria, gathering, num_players)
+            if res_gathering:
+                return res_gathering
+
+        return await self.auto_matchmake_now(client, search_criteria, gathering, num_players)
+
+    async def auto_matchmake_now(self, client, search_criteria: list[matchmaking.MatchmakeSessionSearchCriteria], gathering, num_players: int):
+        # Look for an open gathering in the in-memory index first, the database only gets point updates by ID
+        candidates = self.gathering_index.find_for_search_criteria(client.pid(), search_criteria, gathering, 40)
+        for gid in candidates:
+            try:
+                tmp_gathering = await self.join_gathering(client, gid, num_players)
+            except common.RMCError:
+                continue
+
+            return matchmaking_utils.gathering_type_from_document(tmp_gathering)
+
+        # Nothing usable in the index: search the database, which creates a new gathering if none match
+        res_gathering = matchmaking_utils.find_gathering(self.gatherings_db, self.sequence_db, client,
+                                                         search_criteria, gathering, 40, self.extension_filters)[0]
+
+        await self.join_gathering(client, res_gathering.id, num_players)
+        return res_gathering
+
     async def create_simple_search_object(self, client: rmc.RMCClient, obj: matchmaking_mk8d.SimpleSearchObject):
 
         self.verify_simple_search_object_type(obj)
@@ -248,14 +397,7 @@ class MK8MatchmakeExtensionServer(CommonMatchmakeExtensionServer):
         return list(map(simple_search_object_utils.simple_search_object_from_document, res))
 
     async def join_matchmake_session_with_extra_participants(self, client, gid, join_message, ignore_blacklist, participation_count, extra_participants):
-        gathering = self.gatherings_db.find_one({"id": gid})
-        if not gathering:
-            raise common.RMCError("RendezVous::SessionVoid")
-
-        if not self.can_user_join_gathering(client, gathering):
-            raise common.RMCError("RendezVous::NotFriend")
-
-        gathering = matchmaking_utils.add_user_to_gathering_ex(self.gatherings_db, client, gathering, join_message, participation_count)
+        gathering = await self.join_gathering(client, gid, participation_count)
         return gathering["session_key"]
 
     async def search_simple_search_object_by_object_ids(self, client, ids):
@@ -0,0 +1,41 @@
+from nintendo.nex import common
+from pymongo.collection import Collection
+
+from nex_protocols_common_py.matchmaking_ext_protocol import CommonMatchMakingServerExt
+import nex_protocols_common_py.matchmaking_utils as matchmaking_utils
+from gathering_index import GatheringIndex
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class MK8MatchmakingServerExt(CommonMatchMakingServerExt):
+    def __init__(self,
+                 settings,
+                 gatherings_db: Collection,
+                 sequence_db: Collection,
+                 gathering_index: GatheringIndex):
+
+        super().__init__(settings, gatherings_db, sequence_db)
+        self.gathering_index = gathering_index
+
+    async def logout(self, client):
+        gatherings = list(self.gatherings_db.find({"players": {"$in": [client.pid()]}}))
+        logger.info("Removing disconnected player %d from %d gatherings", client.pid(), len(gatherings))
+        for gathering in gatherings:
+            gathering = matchmaking_utils.remove_user_from_gathering_ex(self.gatherings_db, client, gathering, "")
+            self.gathering_index.update(gathering)
+
+        # Also drop the player from gatherings the index knew about but the database didn't
+        self.gathering_index.remove_player(client.pid())
+
+    # ============= Method implementations  =============
+
+    async def end_participation(self, client, gid, message):
+
+        if len(message) > 256:
+            raise common.RMCError("Core::InvalidArgument")
+
+        gathering = matchmaking_utils.remove_user_from_gathering(self.gatherings_db, client, gid, message)
+        self.gathering_index.update(gathering)
+        return True
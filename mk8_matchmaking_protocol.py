@@ -0,0 +1,23 @@
+from pymongo.collection import Collection
+
+from nex_protocols_common_py.matchmaking_protocol import CommonMatchMakingServer
+from gathering_index import GatheringIndex
+
+
+class MK8MatchmakingServer(CommonMatchMakingServer):
+    def __init__(self,
+                 settings,
+                 gatherings_db: Collection,
+                 sessions_db: Collection,
+                 sequence_db: Collection,
+                 gathering_index: GatheringIndex):
+
+        super().__init__(settings, gatherings_db, sessions_db, sequence_db)
+        self.gathering_index = gathering_index
+
+    # ============= Method implementations  =============
+
+    async def unregister_gathering(self, client, gid):
+        result = await super().unregister_gathering(client, gid)
+        self.gathering_index.remove(gid)
+        return result
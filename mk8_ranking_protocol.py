@@ -1,4 +1,4 @@
-from nintendo.nex import common
+from nintendo.nex import common, ranking
 from pymongo.collection import Collection
 from typing import Callable
 import pymongo
@@ -7,7 +7,8 @@ import struct
 import bson
 import datetime
 
-from nex_protocols_common_py.ranking_protocol import CommonRankingServer
+from nex_protocols_common_py.ranking_protocol import CommonRankingServer, RankingManager
+from ttl_cache import TTLCache
 
 from nintendo.nex.ranking_mk8d import \
     CompetitionRankingGetScoreParam, CompetitionRankingUploadScoreParam,\
@@ -16,6 +17,10 @@ from nintendo.nex.ranking_mk8d import \
 import logging
 logger = logging.getLogger(__name__)
 
+# PID -> Mii name, kept up to date on common data uploads so gathering listings don't need to join commondata.
+# Entries expire so uploads received by other servers are picked up.
+mii_name_cache = TTLCache(ttl=10 * 60, max_size=100000)
+
 
 def mk8_common_data_handler(collection: Collection, pid: int, data: bytes, unique_id: int) -> bool:
 
@@ -95,10 +100,100 @@ def mk8_common_data_handler(collection: Collection, pid: int, data: bytes, uniqu
     }
 
     collection.find_one_and_replace({"pid": pid}, document, upsert=True)
+    mii_name_cache.set(pid, mii_name)
 
     return True
 
 
+class MK8RankingManager(RankingManager):
+
+    def __init__(self, rankings_db: Collection, commondatadb: Collection, redis_db: redis.client.Redis):
+        super().__init__(rankings_db, commondatadb, redis_db)
+
+        # Called with the category after every score upload
+        self.score_listeners: list[Callable[[int], None]] = []
+
+    def set_score_for_pid(self, pid: int, score_data: ranking.RankingScoreData, unique_id: int, replace_all: bool = True):
+        super().set_score_for_pid(pid, score_data, unique_id, replace_all)
+
+        for listener in self.score_listeners:
+            listener(score_data.category)
+
+    def get_top_pids(self, category: int, count: int, desc: bool) -> list[int]:
+        leaders = self.redis_db.zrange(self.get_redis_member_name(category), 0, count - 1, desc)
+        oid_list = [bson.ObjectId(x.decode()) for x in leaders]
+
+        pids = {score["_id"]: score["pid"] for score in self.rankings_db.find({"_id": {"$in": oid_list}}, {"pid": 1})}
+        return [pids[oid] for oid in oid_list if oid in pids]
+
+    # ============= Admin queries  =============
+
+    def get_score_documents(self, oid_list: list[bson.ObjectId], desc: bool, with_common_data: bool) -> list[dict]:
+        if len(oid_list) == 0:
+            return []
+
+        pipeline = [{"$match": {"_id": {"$in": oid_list}}}]
+        projection = {"pid": 1, "category": 1, "score": 1, "groups": 1, "insert_time": 1}
+        if with_common_data:
+            # Scores of players without common data are kept with empty data, so the page is the same either way
+            pipeline.append({"$lookup": {"from": self.commondata_db.name, "localField": "pid", "foreignField": "pid", "as": "user_common_data"}})
+            pipeline.append({"$unwind": {"path": "$user_common_data", "preserveNullAndEmptyArrays": True}})
+            projection["data"] = {"$ifNull": ["$user_common_data.data", bson.Binary(b"")]}
+        pipeline.append({"$project": projection})
+
+        score_list = list(self.rankings_db.aggregate(pipeline))
+        RankingManager.revert_original_object_id_order(score_list, oid_list, desc)
+        return score_list
+
+    def rank_score_documents(self, category: int, score_list: list[dict], desc: bool) -> list[tuple[int, dict]]:
+        # Same standard ranking as get_scores_by_range_standard, only the first score needs a rank lookup
+        res = []
+        if len(score_list) > 0:
+            base_rank = self.get_standard_rank_by_score(category, score_list[0]["score"], desc)
+            count = 0
+            last_score = score_list[0]["score"]
+            for score in score_list:
+                if score["score"] == last_score:
+                    count += 1
+                else:
+                    base_rank += count
+                    count = 1
+
+                last_score = score["score"]
+                res.append((base_rank, score))
+
+        return res
+
+    def get_scores_page(self, category: int, offset: int, count: int, desc: bool, with_common_data: bool) -> tuple[list[tuple[int, dict]], int, bool]:
+        """Returns the (rank, score) entries of a page, the offset of the next page and whether there is one"""
+        # One more entry than asked for tells if the page is the last one
+        leaders = self.redis_db.zrange(self.get_redis_member_name(category), offset, offset + count, desc)
+        has_more = len(leaders) > count
+        leaders = leaders[:count]
+        oid_list = [bson.ObjectId(x.decode()) for x in leaders]
+
+        score_list = self.get_score_documents(oid_list, desc, with_common_data)
+        return self.rank_score_documents(category, score_list, desc), offset + len(leaders), has_more
+
+    def get_scores_page_around_pid(self, pid: int, category: int, count: int, desc: bool, with_common_data: bool) -> tuple[list[tuple[int, dict]], int, int, bool]:
+        """Same as get_scores_page, for the page centered on the best score of the PID, with the page offset"""
+        best_score = self.rankings_db.find_one({"pid": pid, "category": category}, {"_id": 1}, sort=[("score", -1 if desc else 1)])
+        if not best_score:
+            return [], 0, 0, False
+
+        if desc:
+            rank = self.redis_db.zrevrank(self.get_redis_member_name(category), str(best_score["_id"]))
+        else:
+            rank = self.redis_db.zrank(self.get_redis_member_name(category), str(best_score["_id"]))
+
+        if rank is None:
+            return [], 0, 0, False
+
+        offset = max(rank - (count // 2), 0)
+        scores, next_offset, has_more = self.get_scores_page(category, offset, count, desc, with_common_data)
+        return scores, offset, next_offset, has_more
+
+
 class MK8RankingServer(CommonRankingServer):
 
     def __init__(self,
@@ -109,10 +204,13 @@ class MK8RankingServer(CommonRankingServer):
                  common_data_handler: Callable[[Collection, int, bytes, int], bool],
                  rankings_category: dict[int, bool],
                  tournaments_db: Collection,
-                 tournaments_scores_db: Collection):
+                 tournaments_scores_db: Collection,
+                 ranking_mgr: MK8RankingManager):
 
         super().__init__(settings, rankings_db, redis_instance, commondata_db, common_data_handler, rankings_category)
 
+        self.ranking_mgr = ranking_mgr
+
         self.tournaments_db = tournaments_db
         self.tournaments_scores_db = tournaments_scores_db
 
@@ -166,6 +264,11 @@ class MK8RankingServer(CommonRankingServer):
 
     # ============= Method implementations  =============
 
+    async def upload_common_data(self, client, common_data: bytes, unique_id: int):
+        # The handler caches the new name, don't keep the old one if it fails or doesn't run
+        mii_name_cache.delete(client.pid())
+        await super().upload_common_data(client, common_data, unique_id)
+
     async def get_competition_ranking_score(self, client, param: CompetitionRankingGetScoreParam) -> list[CompetitionRankingScoreInfo]:
         if (param.range.size > 5):
             raise common.RMCError("Core::InvalidArgument")
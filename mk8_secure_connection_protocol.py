@@ -0,0 +1,91 @@
+from nintendo.nex import common
+from pymongo.collection import Collection
+import datetime
+import asyncio
+import bson
+
+from nex_protocols_common_py.secure_connection_protocol import CommonSecureConnectionServer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class MK8SecureConnectionServer(CommonSecureConnectionServer):
+    """
+    Secure server whose sessions are tagged with the instance that created them and the boot of that instance,
+    so several secure servers can share the sessions collection. Sessions left behind by a previous boot are removed
+    in the background, and those of an instance that is gone for good expire through the TTL index on last_seen.
+    """
+
+    def __init__(self,
+                 settings,
+                 sessions_db: Collection,
+                 reportdata_db: Collection,
+                 instance_id: str,
+                 session_ttl: int):
+
+        super().__init__(settings, sessions_db, reportdata_db)
+        self.instance_id = instance_id
+        self.boot_id = bson.ObjectId()
+        self.session_ttl = session_ttl
+
+        self.sessions_db.create_index("pid")
+        self.sessions_db.create_index([("instance_id", 1), ("boot_id", 1)])
+        self.create_ttl_index()
+
+    def create_ttl_index(self):
+        # create_index fails with IndexOptionsConflict when only the TTL changed, the existing index is updated instead
+        index = self.sessions_db.index_information().get("last_seen_1")
+        if index and index.get("expireAfterSeconds") != self.session_ttl:
+            self.sessions_db.database.command("collMod", self.sessions_db.name,
+                                              index={"keyPattern": {"last_seen": 1}, "expireAfterSeconds": self.session_ttl})
+        else:
+            self.sessions_db.create_index("last_seen", expireAfterSeconds=self.session_ttl)
+
+    def get_own_sessions_filter(self) -> dict:
+        return {"instance_id": self.instance_id, "boot_id": self.boot_id}
+
+    async def logout(self, client):
+        self.clients.pop(client.client.user_cid)
+        logger.info("Removing disconnected player %d session (RVCID %d)", client.pid(), client.client.user_cid)
+
+        # Connection IDs are only unique within a boot
+        self.sessions_db.delete_one({"cid": client.client.user_cid, **self.get_own_sessions_filter()})
+
+    # ============= Utility functions  =============
+
+    def set_session_for_pid(self, pid: int, urls: list[common.StationURL], cid: int, addr: tuple[str, int]):
+        url_list = self.transform_urls(urls)
+        self.sessions_db.update_one({"pid": pid}, {"$set": {
+            "pid": pid,
+            "cid": cid,
+            "urls": url_list,
+            "ip": addr[0],
+            "port": addr[1],
+            "instance_id": self.instance_id,
+            "boot_id": self.boot_id,
+            "last_seen": datetime.datetime.now(datetime.timezone.utc),
+        }}, upsert=True)
+
+    def remove_stale_sessions(self) -> int:
+        # Only our own instance, the other secure servers sharing the collection may be running
+        result = self.sessions_db.delete_many({"instance_id": self.instance_id, "boot_id": {"$ne": self.boot_id}})
+        return result.deleted_count
+
+    def refresh_sessions(self):
+        self.sessions_db.update_many(self.get_own_sessions_filter(), {"$set": {"last_seen": datetime.datetime.now(datetime.timezone.utc)}})
+
+    async def run(self):
+        try:
+            count = await asyncio.to_thread(self.remove_stale_sessions)
+            logger.info("Removed %d stale sessions of instance %s", count, self.instance_id)
+        except Exception:
+            logger.exception("Failed to remove the stale sessions of instance %s", self.instance_id)
+
+        # Keep the sessions of connected players from expiring, with a single write for all of them
+        while True:
+            await asyncio.sleep(self.session_ttl / 3)
+            try:
+                await asyncio.to_thread(self.refresh_sessions)
+            except Exception:
+                logger.exception("Failed to refresh the sessions of instance %s", self.instance_id)
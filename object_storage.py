@@ -0,0 +1,391 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from minio import Minio
+from minio.credentials import StaticProvider
+from minio.datatypes import PostPolicy
+from minio.error import S3Error
+from email.parser import BytesParser
+from email import policy as email_policy
+from urllib.parse import quote, unquote, urlsplit, parse_qs
+from abc import ABC, abstractmethod
+import datetime
+import asyncio
+import urllib3
+import certifi
+import threading
+import hashlib
+import hmac
+import mmap
+import tempfile
+import time
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def create_s3_client(endpoint: str, access_key: str, secret: str, region: str, max_connections: int, timeout: float) -> Minio:
+    # With the region set, signing URLs and policies never has to ask the server for the bucket location
+    http_client = urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=timeout, read=timeout),
+        maxsize=max_connections,
+        block=True,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=certifi.where(),
+        retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
+
+    return Minio(endpoint=endpoint,
+                 secure=True,
+                 region=region,
+                 http_client=http_client,
+                 credentials=StaticProvider(access_key, secret, ""))
+
+
+class BlobCache:
+    """LRU of object contents by key, bounded by their total size"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.lock = threading.Lock()  # Objects are written from the storage thread pool
+        self.version = 0  # Incremented on every delete, to detect reads that raced with a write
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def contains(self, key: str) -> bool:
+        return key in self.entries
+
+    def set(self, key: str, data: bytes, version: int | None = None):
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+
+            self.size -= len(self.entries.pop(key, b""))
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+    def delete(self, key: str):
+        with self.lock:
+            self.size -= len(self.entries.pop(key, b""))
+            self.version += 1
+
+
+class ObjectStorage(ABC):
+    """Where the DataStore objects are kept, clients upload and download them directly with signed URLs"""
+
+    def __init__(self, max_workers: int, thread_name_prefix: str):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+        # Only used by backends that serve the downloads themselves
+        self.blob_cache: BlobCache | None = None
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    @abstractmethod
+    async def stat_object(self, key: str) -> tuple[int, str]:
+        """Size and MD5 (hex) of the uploaded object, (0, "") when it doesn't exist"""
+
+    @abstractmethod
+    async def remove_object(self, key: str):
+        pass
+
+    @abstractmethod
+    async def get_object(self, key: str) -> bytes | None:
+        pass
+
+    @abstractmethod
+    def presigned_get_url(self, key: str, lifetime: datetime.timedelta) -> str:
+        pass
+
+    @abstractmethod
+    def presigned_post(self, key: str, size: int, lifetime: datetime.timedelta) -> tuple[str, dict[str, str]]:
+        """URL and form fields of a multipart POST upload of exactly size bytes"""
+
+
+class S3ObjectStorage(ObjectStorage):
+    """
+    DataStore objects in an S3 bucket. The Minio client is synchronous, so the calls that go over the network
+    run in a thread pool sized like its connection pool, and never block the event loop.
+    """
+
+    def __init__(self, s3_client: Minio, bucket: str, max_workers: int):
+        super().__init__(max_workers, "s3")
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    async def stat_object(self, key: str) -> tuple[int, str]:
+        try:
+            stat = await self.run(self.s3_client.stat_object, self.bucket, key)
+        except S3Error as e:
+            if e.code in ["NoSuchKey", "NoSuchObject"]:
+                return 0, ""
+            raise
+
+        # The ETag of an object uploaded in one part (POST uploads always are) is its MD5
+        return stat.size, stat.etag.strip('"')
+
+    async def remove_object(self, key: str):
+        await self.run(self.s3_client.remove_object, self.bucket, key)
+
+    def read_object(self, key: str) -> bytes | None:
+        try:
+            response = self.s3_client.get_object(self.bucket, key)
+        except S3Error as e:
+            if e.code in ["NoSuchKey", "NoSuchObject"]:
+                return None
+            raise
+
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    async def get_object(self, key: str) -> bytes | None:
+        return await self.run(self.read_object, key)
+
+    # Signing is done locally, no need for the thread pool
+
+    def presigned_get_url(self, key: str, lifetime: datetime.timedelta) -> str:
+        return self.s3_client.presigned_get_object(self.bucket, key, lifetime)
+
+    def presigned_post(self, key: str, size: int, lifetime: datetime.timedelta) -> tuple[str, dict[str, str]]:
+        policy = PostPolicy(self.bucket, datetime.datetime.utcnow() + lifetime)
+        policy.add_equals_condition("key", key)
+        policy.add_content_length_range_condition(size, size)
+        form = self.s3_client.presigned_post_policy(policy)
+        form["key"] = key
+
+        return self.s3_client._base_url._url.geturl() + "/" + self.bucket, form
+
+
+class LocalObjectStorage(ObjectStorage):
+    """
+    DataStore objects as files on the local disk, for small deployments and test rigs without S3.
+    Files are spread over 256 * 256 directories by the hash of their key, and served by serve()
+    at public_url with URLs signed like S3 ones (HMAC of the key, size and expiry time).
+    """
+
+    MAX_UPLOAD_SIZE = 16 * 1024 * 1024 + 64 * 1024  # Largest DataStore object plus the multipart overhead
+    SEND_CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, root: str, public_url: str, secret: str, max_workers: int = 4, cache_max_bytes: int = 0):
+        super().__init__(max_workers, "local_storage")
+        self.root = root
+        self.public_url = public_url.rstrip("/")
+        self.secret = secret.encode("utf-8")
+
+        if cache_max_bytes > 0:
+            self.blob_cache = BlobCache(cache_max_bytes)
+
+    def path(self, key: str) -> str:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[0:2], digest[2:4], digest)
+
+    def sign(self, *values) -> str:
+        message = "\n".join(str(value) for value in values).encode("utf-8")
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def verify(self, signature: str, expires: str, *values) -> bool:
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+
+        return hmac.compare_digest(signature, self.sign(*values, expires))
+
+    # ============= Storage =============
+
+    def hash_object(self, key: str) -> tuple[int, str]:
+        data = self.map_object(key)
+        if data is None:
+            return 0, ""
+
+        try:
+            return len(data), hashlib.md5(data).hexdigest()
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    async def stat_object(self, key: str) -> tuple[int, str]:
+        return await self.run(self.hash_object, key)
+
+    async def remove_object(self, key: str):
+        if self.blob_cache:
+            self.blob_cache.delete(key)
+
+        try:
+            await self.run(os.remove, self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def read_object(self, key: str) -> bytes | None:
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def get_object(self, key: str) -> bytes | None:
+        return await self.run(self.read_object, key)
+
+    def presigned_get_url(self, key: str, lifetime: datetime.timedelta) -> str:
+        expires = int(time.time() + lifetime.total_seconds())
+        return "%s/%s?expires=%d&signature=%s" % (self.public_url, quote(key), expires, self.sign("GET", key, expires))
+
+    def presigned_post(self, key: str, size: int, lifetime: datetime.timedelta) -> tuple[str, dict[str, str]]:
+        expires = int(time.time() + lifetime.total_seconds())
+        form = {
+            "key": key,
+            "size": str(size),
+            "expires": str(expires),
+            "signature": self.sign("POST", key, size, expires),
+        }
+        return self.public_url + "/", form
+
+    def write_object(self, key: str, data: bytes):
+        # Written next to the destination then renamed, so downloads never see a partial file
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        if self.blob_cache:
+            self.blob_cache.delete(key)
+
+    def map_object(self, key: str) -> mmap.mmap | bytes | None:
+        try:
+            with open(self.path(key), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    async def put_object(self, key: str, data: bytes):
+        await self.run(self.write_object, key, data)
+
+    # ============= HTTP =============
+
+    async def handle_get(self, writer: asyncio.StreamWriter, key: str, query: dict[str, list[str]]) -> str:
+        if not self.verify(query.get("signature", [""])[0], query.get("expires", [""])[0], "GET", key):
+            return "403 Forbidden"
+
+        data = self.blob_cache.get(key) if self.blob_cache else None
+        if data is None:
+            data = await self.run(self.map_object, key)
+            if data is None:
+                return "404 Not Found"
+
+        try:
+            writer.write(("HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                          "Content-Length: %d\r\nConnection: close\r\n\r\n" % len(data)).encode("latin-1"))
+
+            # Slicing copies out of the mapping, so it can be closed whatever the transport still holds
+            for offset in range(0, len(data), self.SEND_CHUNK_SIZE):
+                writer.write(data[offset:offset + self.SEND_CHUNK_SIZE])
+                await writer.drain()
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+        return "200 OK"
+
+    @staticmethod
+    def parse_multipart(content_type: str, body: bytes) -> tuple[dict[str, str], bytes | None] | None:
+        message = BytesParser(policy=email_policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+        if not message.is_multipart():
+            return None
+
+        fields = {}
+        data = None
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name == "file":
+                data = part.get_payload(decode=True)
+            elif name:
+                fields[name] = part.get_content().strip()
+
+        return fields, data
+
+    async def handle_post(self, reader: asyncio.StreamReader, headers: dict[str, str]) -> str:
+        length = int(headers.get("content-length", "0"))
+        if length <= 0 or length > self.MAX_UPLOAD_SIZE:
+            return "400 Bad Request"
+
+        body = await asyncio.wait_for(reader.readexactly(length), 60)
+
+        # Parsing a large upload takes a while, it must not hold up the RMC clients
+        parsed = await self.run(self.parse_multipart, headers.get("content-type", ""), body)
+        if parsed is None:
+            return "400 Bad Request"
+
+        fields, data = parsed
+        key = fields.get("key", "")
+        size = fields.get("size", "")
+        if data is None or not self.verify(fields.get("signature", ""), fields.get("expires", ""), "POST", key, size):
+            return "403 Forbidden"
+
+        if str(len(data)) != size:
+            return "400 Bad Request"
+
+        await self.put_object(key, data)
+        return "204 No Content"
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        status = "400 Bad Request"
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2:
+                url = urlsplit(parts[1])
+                if parts[0] == "GET":
+                    status = await self.handle_get(writer, unquote(url.path.lstrip("/")), parse_qs(url.query))
+                elif parts[0] == "POST":
+                    status = await self.handle_post(reader, headers)
+                else:
+                    status = "405 Method Not Allowed"
+
+            if status != "200 OK":
+                writer.write(("HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % status).encode("latin-1"))
+                await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("Error while handling a local storage request")
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self.handle_http, host, port)
+        logger.info("Serving DataStore objects from %s on http://%s:%d (%s)", self.root, host, port, self.public_url)
+        return server
@@ -0,0 +1,213 @@
+from nintendo.nex import common
+from pymongo import monitoring
+from collections import deque
+from logging.handlers import RotatingFileHandler
+import contextvars
+import cProfile
+import datetime
+import asyncio
+import pstats
+import traceback
+import random
+import json
+import time
+import io
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Slow calls are written as one JSON object per line to their own log file
+slow_calls_logger = logging.getLogger("slow_calls")
+slow_calls_logger.propagate = False
+
+
+class CallProfile:
+    def __init__(self, protocol_id: int, method_id: int, method: str, pid: int):
+        self.protocol_id = protocol_id
+        self.method_id = method_id
+        self.method = method
+        self.pid = pid
+
+        self.mongo_time = 0.0
+        self.mongo_calls = 0
+        self.redis_time = 0.0
+        self.redis_calls = 0
+
+
+current_call: contextvars.ContextVar[CallProfile | None] = contextvars.ContextVar("current_call", default=None)
+
+
+class ProfilerMongoListener(monitoring.CommandListener):
+    # Listeners are called synchronously by the thread sending the command, so the context is the caller's
+    def started(self, event: monitoring.CommandStartedEvent):
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self.finish(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.finish(event)
+
+    def finish(self, event):
+        call = current_call.get()
+        if call is not None:
+            call.mongo_time += event.duration_micros / 1000000
+            call.mongo_calls += 1
+
+
+class Profiler:
+    """
+    Opt-in profiling of the RMC methods: calls slower than the threshold are recorded with their
+    MongoDB/Redis time, payload sizes and the coroutine stack at the moment they became slow.
+    A fraction of the calls also run under cProfile, whose stats are kept if they turn out slow.
+    """
+
+    def __init__(self, enabled: bool = False, threshold: float = 0.25, sample_rate: float = 0.0, max_records: int = 200):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.records = deque(maxlen=max_records)
+
+        # Only one cProfile profiler can be active at a time
+        self.is_profiling = False
+
+        # Without the hooks, enabling the profiler has no effect
+        self.installed = False
+
+    def configure(self, enabled: bool, threshold: float, sample_rate: float):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+
+    def set_log_file(self, filename: str, max_bytes: int, backup_count: int):
+        handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        slow_calls_logger.addHandler(handler)
+        slow_calls_logger.setLevel(logging.INFO)
+
+    # ============= Instrumentation =============
+
+    def instrument_server(self, server):
+        self.installed = True
+        for method_id, handler in list(server.methods.items()):
+            server.methods[method_id] = self.wrap_method(server.PROTOCOL_ID, method_id, handler)
+
+    def wrap_method(self, protocol_id: int, method_id: int, handler):
+        name = handler.__name__
+        if name.startswith("handle_"):
+            name = name[len("handle_"):]
+
+        async def wrapper(client, input, output):
+            if not self.enabled:
+                return await handler(client, input, output)
+
+            call = CallProfile(protocol_id, method_id, name, client.pid() if client else 0)
+            token = current_call.set(call)
+
+            stack = []
+            task = asyncio.current_task()
+            watchdog = asyncio.get_running_loop().call_later(self.threshold, self.capture_stack, task, stack)
+
+            # Other tasks running while this call awaits are profiled too, the stats are an approximation
+            profile = None
+            if (not self.is_profiling) and self.sample_rate > 0 and random.random() < self.sample_rate:
+                self.is_profiling = True
+                profile = cProfile.Profile()
+                profile.enable()
+
+            error = None
+            start = time.perf_counter()
+            try:
+                await handler(client, input, output)
+            except common.RMCError as e:
+                error = e.name()
+                raise
+            except Exception as e:
+                error = "PythonCore::%s" % e.__class__.__name__
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                watchdog.cancel()
+                current_call.reset(token)
+
+                if profile is not None:
+                    profile.disable()
+                    self.is_profiling = False
+
+                if elapsed >= self.threshold:
+                    self.record(call, elapsed, input.size(), output.size(), error, stack, profile)
+
+        wrapper.__name__ = handler.__name__
+        return wrapper
+
+    def register_mongo_listener(self):
+        # Must be called before the MongoClient is created
+        monitoring.register(ProfilerMongoListener())
+
+    def instrument_redis(self, redis_client):
+        execute_command = redis_client.execute_command
+
+        def wrapper(*args, **options):
+            call = current_call.get()
+            if call is None:
+                return execute_command(*args, **options)
+
+            start = time.perf_counter()
+            try:
+                return execute_command(*args, **options)
+            finally:
+                call.redis_time += time.perf_counter() - start
+                call.redis_calls += 1
+
+        redis_client.execute_command = wrapper
+
+    # ============= Recording =============
+
+    @staticmethod
+    def capture_stack(task: asyncio.Task, stack: list):
+        # Where the call is currently waiting, taken once it went over the threshold
+        if task is None or task.done():
+            return
+
+        frames = []
+        coro = task.get_coro()
+        while coro is not None:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is None:
+                break
+
+            frames.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name, None))
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+
+        stack.append("".join(traceback.StackSummary.from_list(frames).format()))
+
+    def record(self, call: CallProfile, elapsed: float, input_size: int, output_size: int, error: str | None, stack: list, profile: cProfile.Profile | None):
+        profile_stats = ""
+        if profile is not None:
+            buffer = io.StringIO()
+            pstats.Stats(profile, stream=buffer).sort_stats("cumulative").print_stats(30)
+            profile_stats = buffer.getvalue()
+
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "protocol_id": call.protocol_id,
+            "method_id": call.method_id,
+            "method": call.method,
+            "pid": call.pid,
+            "wall_time": elapsed,
+            "mongo_time": call.mongo_time,
+            "mongo_calls": call.mongo_calls,
+            "redis_time": call.redis_time,
+            "redis_calls": call.redis_calls,
+            "input_size": input_size,
+            "output_size": output_size,
+            "error": error or "",
+            "stack": stack[0] if len(stack) > 0 else "",
+            "profile": profile_stats,
+        }
+
+        self.records.append(record)
+        slow_calls_logger.info(json.dumps(record))
+
+
+profiler = Profiler()
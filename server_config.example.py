@@ -2,6 +2,7 @@ from nintendo.nex import settings
 import pymongo
 import pymongo
 import urllib.parse
+import socket
 
 GAME_SERVER_ID = 0x1010EB00
 ACCESS_KEY = "25dbf96a"
@@ -48,19 +49,60 @@ class NEXConfig:
         self.nex_secure_user_password = "abcdef123456"  # PLEASE, make this a real private password.
         self.nex_external_address = "147.147.147.147"  # Your external IP, for external clients to connect.
 
+        # Must be unique among the secure servers sharing the database, a server only removes its own sessions when it restarts.
+        # Sessions of a server that stopped for good expire after session_ttl seconds.
+        self.instance_id = "%s:%d" % (socket.gethostname(), self.nex_secure_port)
+        self.session_ttl = 10 * 60
+
         self.friends_grpc_host = "123.123.123.123"
         self.friends_grpc_port = 1002
         self.friends_grpc_api_key = "abcdefghijklmnopqrstuvwxyz123456789"
+        self.friends_cache_ttl = 60  # Seconds a friend list is reused for friend-only room checks
+        self.friends_cache_size = 10000
 
         self.account_grpc_host = "124.124.124.124"
         self.account_grpc_port = 1003
         self.account_grpc_api_key = "abcdefghijklmnopqrstuvwxyz123456789"
+        self.nex_password_cache_ttl = 30  # Seconds a NEX password is kept in memory after a login
+        self.nex_password_cache_size = 50000
+        self.account_breaker_failure_threshold = 5  # Consecutive account service errors before failing logins fast
+        self.account_breaker_reset_timeout = 10  # Seconds before trying the account service again
+
+        self.grpc_client_timeout = 5  # Seconds before a call to the friends/account services is given up
+        self.startup_check_timeout = 10  # Seconds MongoDB, Redis, S3 and the gRPC services are given to answer at startup, checked concurrently
 
         # These gRPC credentials are for the server we're implementing
         self.mario_kart_8_grpc_host = "localhost"
         self.mario_kart_8_grpc_port = 50051
         self.mario_kart_8_grpc_api_key = "abcdefghijklmnopqrstuvwxyz123456789"
 
+        # Logs are written by a background thread, each message template is limited to log_rate_limit lines every log_rate_interval seconds (0 for no limit)
+        self.log_level = "INFO"
+        self.log_json = False
+        self.log_rate_limit = 20
+        self.log_rate_interval = 10
+        self.log_sample_every = 100  # Past the limit, one line in log_sample_every is still written (0 for none)
+
+        # Prometheus metrics (RMC methods, MongoDB and Redis) are served on http://metrics_host:metrics_port/metrics (0 to disable)
+        self.metrics_host = "127.0.0.1"
+        self.metrics_port = 9100
+
+        # RMC calls slower than profiler_threshold seconds are recorded (GetSlowCalls), a fraction of the calls also run under cProfile.
+        # Once enabled here, it can be turned off and on again at runtime with ConfigureProfiler.
+        self.profiler_enabled = False
+        self.profiler_threshold = 0.25
+        self.profiler_sample_rate = 0.01
+        self.profiler_log_file = "slow_calls.log"  # Empty to only keep them in memory
+        self.profiler_log_max_bytes = 10 * 1024 * 1024
+        self.profiler_log_backup_count = 5
+
+        # Kicking everyone (maintenance, KickAllUsers) disconnects this many clients at once, spread over this many seconds
+        self.kick_concurrency = 64
+        self.kick_spread_time = 30
+
+        # Auto-matchmaking requests are buffered for this many seconds then assigned to rooms in batches (0 to disable, 0.05 is a good start)
+        self.matchmaking_batch_window = 0
+
         self.account_database = "pretendo"
 
         self.pnid_collection = "pnids"
@@ -84,12 +126,34 @@ class NEXConfig:
         self.datastore_collection = "datastore"
         self.restriction_collection = "restrictions"
 
+        # "s3", or "local" to keep DataStore objects on this machine and serve them over HTTP (no S3 needed)
+        self.storage_backend = "s3"
+        self.local_storage_root = "datastore_objects"
+        self.local_storage_host = "0.0.0.0"
+        self.local_storage_port = 8380
+        self.local_storage_public_url = "http://127.0.0.1:8380"  # How consoles reach local_storage_host:local_storage_port
+        self.local_storage_secret = "change-me"  # Signs the download/upload URLs
+
         self.s3_endpoint_domain = "..."
         self.s3_endpoint = "https://" + self.s3_endpoint_domain
         self.s3_access_key = "..."
         self.s3_secret = "..."
         self.s3_region = "..."
         self.bucket_name = "amkj"
+        self.s3_max_connections = 16  # S3 calls run in a thread pool of this size, with as many pooled connections
+        self.s3_timeout = 10
+
+        # Ghost/MKTV download URLs are valid for s3_url_lifetime seconds, and the same URL is handed out for s3_url_reuse_time seconds (0 to always sign a new one)
+        self.s3_url_lifetime = 15 * 60
+        self.s3_url_reuse_time = 10 * 60
+        self.s3_url_cache_size = 100000
+        self.datastore_info_cache_size = 50000  # DataStore objects whose size/owner are kept in memory for GetObjectInfos
+
+        # After a time trial leaderboard changes, the download URLs of its top ghost_prefetch_count ghosts are signed in advance (0 to disable).
+        # With the local storage backend, their contents are also kept in memory, up to ghost_cache_max_bytes.
+        self.ghost_prefetch_count = 20
+        self.ghost_prefetch_interval = 5
+        self.ghost_cache_max_bytes = 256 * 1024 * 1024
 
         self.redis_uri = "redis://53.53.53.53:1005"  # redis://HOST[:PORT][?db=DATABASE[&password=PASSWORD]]
 
@@ -0,0 +1,77 @@
+from typing import Awaitable, Callable
+import contextlib
+import asyncio
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class StartupError(Exception):
+    pass
+
+
+class StartupTimer:
+    """Times the startup phases, from the process start to the server accepting connections"""
+
+    def __init__(self, start: float):
+        self.start = start
+        self.phases: list[tuple[str, float]] = []
+
+    def record(self, name: str, begin: float):
+        duration = time.perf_counter() - begin
+        self.phases.append((name, duration))
+        logger.info("Startup: %s took %.3fs", name, duration)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, begin)
+
+    def finish(self):
+        total = time.perf_counter() - self.start
+        phases = ", ".join("%s %.3fs" % (name, duration) for name, duration in self.phases)
+        logger.info("Server ready in %.3fs (%s)", total, phases)
+
+
+class ReadinessCheck:
+    def __init__(self, name: str, check: Callable[[], Awaitable], required: bool = True):
+        self.name = name
+        self.check = check
+        self.required = required
+
+
+def in_thread(func: Callable, *args) -> Callable[[], Awaitable]:
+    """For blocking client calls, so they can be checked at the same time as the others"""
+    return lambda: asyncio.to_thread(func, *args)
+
+
+async def run_check(check: ReadinessCheck, timeout: float) -> Exception | None:
+    begin = time.perf_counter()
+    try:
+        await asyncio.wait_for(check.check(), timeout)
+    except asyncio.TimeoutError:
+        error = StartupError("No answer after %.1fs" % timeout)
+    except Exception as e:
+        error = e
+    else:
+        logger.info("Startup: %s is ready (%.3fs)", check.name, time.perf_counter() - begin)
+        return None
+
+    if check.required:
+        logger.error("Startup: %s is not ready: %s", check.name, error)
+    else:
+        logger.warning("Startup: %s is not ready, continuing without it: %s", check.name, error)
+    return error
+
+
+async def wait_ready(checks: list[ReadinessCheck], timeout: float):
+    """Runs all the checks concurrently, raises StartupError if a required service did not answer in time"""
+    errors = await asyncio.gather(*[run_check(check, timeout) for check in checks])
+
+    failed = [check.name for check, error in zip(checks, errors) if error is not None and check.required]
+    if failed:
+        raise StartupError("Required services are not ready: %s" % ", ".join(failed))
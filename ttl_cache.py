@@ -0,0 +1,41 @@
+from collections import OrderedDict
+import time
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after a fixed time (never when ttl is None)"""
+
+    def __init__(self, ttl: float | None, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[object, tuple[float, object]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def contains(self, key) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)